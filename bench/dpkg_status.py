@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Compares reading installed package versions straight from the dpkg status file with asking dpkg-query, on a
+# synthetic status file.
+#
+# Usage: python3 bench/dpkg_status.py [--packages N] [--rounds N]
+
+import asyncio
+import json
+import tempfile
+from argparse import ArgumentParser
+from os import path
+from statistics import median
+from subprocess import CalledProcessError, check_output
+from sys import path as sys_path
+from time import perf_counter
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from branchy.packages import PackageState, read_dpkg_status  # noqa: E402
+from branchy.sys import get_installed_package_versions  # noqa: E402
+
+DESCRIPTION = 'Description: synthetic package\n' + ''.join(f' line {i} of a long description\n' for i in range(8))
+
+
+def get_native_arch() -> str:
+    try:
+        return check_output(['dpkg', '--print-architecture'], text=True).strip()
+    except (OSError, CalledProcessError):
+        return 'arm64'
+
+
+def write_status_file(admindir: str, count: int):
+    # dpkg-query takes the native architecture from the host, so the synthetic packages have to match it.
+    native_arch = get_native_arch()
+
+    with open(path.join(admindir, 'status'), 'w') as f:
+        f.write(f'Package: dpkg\nStatus: install ok installed\nMaintainer: Nobody <nobody@example.com>\n'
+                f'Architecture: {native_arch}\nVersion: 1.22.6\n{DESCRIPTION}\n')
+        for i in range(count):
+            arch = 'all' if i % 5 == 0 else native_arch
+            multi_arch = 'Multi-Arch: same\n' if i % 3 == 0 and arch != 'all' else ''
+            f.write(f'Package: pkg{i}\nStatus: install ok installed\nPriority: optional\nSection: misc\n'
+                    f'Installed-Size: {i}\nMaintainer: Nobody <nobody@example.com>\nArchitecture: {arch}\n{multi_arch}'
+                    f'Version: {i}.0-{i % 7}furios1\nDepends: libc6 (>= 2.36)\n{DESCRIPTION}\n')
+
+
+def time_rounds(rounds: int, function) -> float:
+    times = []
+    for _ in range(rounds):
+        started = perf_counter()
+        function()
+        times.append(perf_counter() - started)
+    return median(times)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark dpkg status parsing against dpkg-query')
+    parser.add_argument('--packages', type=int, default=5000)
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as admindir:
+        write_status_file(admindir, args.packages)
+        status_path = path.join(admindir, 'status')
+
+        native = time_rounds(args.rounds, lambda: read_dpkg_status(status_path))
+        subprocess = time_rounds(args.rounds, lambda: asyncio.run(get_installed_package_versions(admindir=admindir)))
+
+        # Once the snapshot is taken, repeat calls only stat() the status file.
+        package_state = PackageState(status_path)
+        asyncio.run(package_state.get_installed_versions())
+        cached = time_rounds(args.rounds, lambda: asyncio.run(package_state.get_installed_versions()))
+
+        print(json.dumps({
+            'packages': args.packages,
+            'same_result': read_dpkg_status(status_path) == asyncio.run(get_installed_package_versions(admindir=admindir)),
+            'native_ms': round(native * 1000, 3),
+            'dpkg_query_ms': round(subprocess * 1000, 3),
+            'cached_ms': round(cached * 1000, 3),
+            'speedup': round(subprocess / native, 1),
+        }, indent=2))
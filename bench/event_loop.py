@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Measures idle wakeups per second and event dispatch latency for the two ways Branchy can drive GLib and asyncio:
+#
+#   poll: the old loop, which drains the GLib main context and then sleeps for 1/160 s, forever
+#   glib: asyncio running on top of the GLib main loop through gi.events.GLibEventLoopPolicy
+#
+# Usage: python3 bench/event_loop.py [--mode poll|glib|both] [--idle SECONDS] [--samples N]
+
+import asyncio
+import json
+import threading
+from argparse import ArgumentParser
+from os import path
+from statistics import mean, median, quantiles
+from sys import path as sys_path
+from time import perf_counter, sleep
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from gi.repository import GLib  # noqa: E402
+
+
+def context_switches() -> int:
+    total = 0
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches')):
+                total += int(line.split()[1])
+    return total
+
+
+def summarize(samples: list[float]) -> dict:
+    ms = [s * 1000 for s in samples]
+    return {
+        'mean_ms': round(mean(ms), 3),
+        'median_ms': round(median(ms), 3),
+        'p95_ms': round(quantiles(ms, n=20)[-1], 3),
+        'max_ms': round(max(ms), 3),
+    }
+
+
+async def measure(idle: float, samples: int) -> dict:
+    loop = asyncio.get_running_loop()
+
+    # Idle wakeups: nothing is scheduled, so every context switch is the loop waking up for no reason.
+    await asyncio.sleep(0.2)
+    before = context_switches()
+    started = perf_counter()
+    await asyncio.sleep(idle)
+    wakeups = (context_switches() - before) / (perf_counter() - started)
+
+    async def dispatch_latency(schedule) -> list[float]:
+        results = []
+        for _ in range(samples):
+            done = asyncio.Event()
+            sent = []
+
+            def fire():
+                sent.append(perf_counter())
+                schedule(lambda: (results.append(perf_counter() - sent[0]), done.set()))
+
+            # Events arrive from another thread, like input events or D-Bus messages do.
+            thread = threading.Thread(target=lambda: (sleep(0.003), fire()))
+            thread.start()
+            await done.wait()
+            thread.join()
+        return results
+
+    def glib_idle(callback):
+        GLib.idle_add(lambda: loop.call_soon_threadsafe(callback) and False)
+
+    def glib_direct(callback):
+        GLib.idle_add(lambda: callback() and False)
+
+    return {
+        'idle_wakeups_per_second': round(wakeups, 1),
+        'glib_event_latency': summarize(await dispatch_latency(glib_direct)),
+        'glib_to_asyncio_latency': summarize(await dispatch_latency(glib_idle)),
+        'asyncio_callback_latency': summarize(await dispatch_latency(loop.call_soon_threadsafe)),
+    }
+
+
+def run_poll(idle: float, samples: int) -> dict:
+    async def main():
+        main_context = GLib.MainContext.default()
+
+        async def pump():
+            while True:
+                while main_context.pending():
+                    main_context.iteration(False)
+                await asyncio.sleep(1 / 160)
+
+        pump_task = asyncio.create_task(pump())
+        try:
+            return await measure(idle, samples)
+        finally:
+            pump_task.cancel()
+
+    return asyncio.run(main())
+
+
+def run_glib(idle: float, samples: int) -> dict:
+    from gi.events import GLibEventLoopPolicy
+
+    policy = GLibEventLoopPolicy()
+    asyncio.set_event_loop_policy(policy)
+    try:
+        loop = policy.get_event_loop()
+        return loop.run_until_complete(measure(idle, samples))
+    finally:
+        asyncio.set_event_loop_policy(None)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the Branchy event loop integration')
+    parser.add_argument('--mode', choices=['poll', 'glib', 'both'], default='both')
+    parser.add_argument('--idle', type=float, default=5.0, help='seconds to stay idle while counting wakeups')
+    parser.add_argument('--samples', type=int, default=200, help='number of events to time for each latency test')
+    args = parser.parse_args()
+
+    results = {}
+    if args.mode in ('poll', 'both'):
+        results['poll'] = run_poll(args.idle, args.samples)
+    if args.mode in ('glib', 'both'):
+        results['glib'] = run_glib(args.idle, args.samples)
+
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Runs the branch list fetch against a local server that is slow, fails or stalls on purpose, and checks that the
+# shared client keeps its connection, retries, times out and compresses the way it should.
+#
+# Usage: python3 bench/http_client.py [--fetches N] [--latency SECONDS] [--records N]
+
+import asyncio
+import json
+import tempfile
+from argparse import ArgumentParser
+from os import path
+from sys import path as sys_path
+from time import perf_counter
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from branchy.cache import ResponseCache  # noqa: E402
+from branchy.http import HttpClient, HttpStatusError  # noqa: E402
+from branchy.sys import fetch_branch_records  # noqa: E402
+from server import BranchListServer, ServerOptions  # noqa: E402
+
+
+async def fetch_all(server: BranchListServer, directory: str, fetches: int, shared: bool) -> float:
+    http = HttpClient()
+    started = perf_counter()
+    for i in range(fetches):
+        cache = ResponseCache(f'fetch{i}', directory)
+        if shared:
+            await fetch_branch_records(http, cache, server.url)
+        else:
+            # What every refresh used to do: a session of its own, thrown away afterwards.
+            await fetch_branch_records(http, cache, server.url)
+            await http.close()
+    elapsed = perf_counter() - started
+    await http.close()
+    return elapsed
+
+
+async def keepalive(args, directory: str) -> dict:
+    results = {}
+    for shared in (False, True):
+        async with BranchListServer(ServerOptions(args.records, args.latency)) as server:
+            elapsed = await fetch_all(server, directory, args.fetches, shared)
+            results['shared' if shared else 'per_fetch'] = {
+                'ms': round(elapsed * 1000, 3),
+                'connections': len(server.stats.connections),
+            }
+    return results
+
+
+async def retries(args, directory: str) -> dict:
+    async with BranchListServer(ServerOptions(args.records, fail_first=2)) as server:
+        http = HttpClient(retry_delay=0.05)
+        _, records = await fetch_branch_records(http, ResponseCache('retries', directory), server.url)
+        await http.close()
+        succeeded = {'attempts': http.attempts, 'records': len(records)}
+
+    async with BranchListServer(ServerOptions(args.records, fail_first=100)) as server:
+        http = HttpClient(retries=2, retry_delay=0.05)
+        try:
+            await fetch_branch_records(http, ResponseCache('give-up', directory), server.url)
+            error = None
+        except HttpStatusError as e:
+            error = str(e)
+        await http.close()
+        gave_up = {'attempts': http.attempts, 'error': error}
+
+    return {'after_failures': succeeded, 'giving_up': gave_up}
+
+
+async def timeouts(args, directory: str) -> dict:
+    async with BranchListServer(ServerOptions(args.records, stall_after=100)) as server:
+        http = HttpClient(read_timeout=0.5, retries=1, retry_delay=0.05)
+        started = perf_counter()
+        try:
+            await fetch_branch_records(http, ResponseCache('stall', directory), server.url)
+            error = None
+        except asyncio.TimeoutError as e:
+            error = repr(e)
+        await http.close()
+        return {'error': error, 'attempts': http.attempts, 'ms': round((perf_counter() - started) * 1000, 3)}
+
+
+async def compression(args, directory: str) -> dict:
+    results = {}
+    for compress in (False, True):
+        async with BranchListServer(ServerOptions(args.records)) as server:
+            http = HttpClient(compress=compress)
+            cache = ResponseCache(f'compress-{compress}', directory)
+            _, records = await fetch_branch_records(http, cache, server.url)
+            await http.close()
+            results['compressed' if compress else 'identity'] = {
+                'compressed_responses': server.stats.compressed,
+                'records': len(records),
+                'cached_bytes': path.getsize(cache.body_path),
+            }
+    return results
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        print(json.dumps({
+            'keepalive': await keepalive(args, directory),
+            'retries': await retries(args, directory),
+            'timeouts': await timeouts(args, directory),
+            'compression': await compression(args, directory),
+        }, indent=2))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Check the HTTP client against a misbehaving local server')
+    parser.add_argument('--fetches', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--records', type=int, default=2000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Compares running the three stages of a refresh (installed versions, branch list, sources) one after another with
+# running them at the same time, against a local server that takes --delay to answer.
+#
+# Usage: python3 bench/refresh.py [--delay SECONDS] [--packages N] [--rounds N]
+
+import asyncio
+import json
+import tempfile
+from argparse import ArgumentParser
+from os import path
+from statistics import median
+from sys import path as sys_path
+from time import perf_counter
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from branchy.cache import ResponseCache  # noqa: E402
+from branchy.http import HttpClient  # noqa: E402
+from branchy.packages import PackageState  # noqa: E402
+from branchy.sys import fetch_branch_records, get_enabled_branches  # noqa: E402
+from dpkg_status import write_status_file  # noqa: E402
+from server import BranchListServer, ServerOptions  # noqa: E402
+
+
+# Both start by dropping the cached list, so the server can't answer with 304 and every round downloads all of it.
+async def sequential(http: HttpClient, status_path: str, cache, url: str, sources_dir: str):
+    cache.clear()
+    await PackageState(status_path).get_installed_versions()
+    await fetch_branch_records(http, cache, url)
+    get_enabled_branches(sources_dir)
+
+
+async def concurrent(http: HttpClient, status_path: str, cache, url: str, sources_dir: str):
+    cache.clear()
+    await asyncio.gather(
+        PackageState(status_path).get_installed_versions(),
+        fetch_branch_records(http, cache, url),
+        asyncio.get_running_loop().run_in_executor(None, get_enabled_branches, sources_dir),
+    )
+
+
+async def time_rounds(rounds: int, function, *args) -> float:
+    times = []
+    for _ in range(rounds):
+        started = perf_counter()
+        await function(*args)
+        times.append(perf_counter() - started)
+    return median(times)
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        write_status_file(directory, args.packages)
+        with open(path.join(directory, 'furios.list'), 'w') as f:
+            f.write('deb http://furilabs-repo1.repo.furios.io/trixie-branch1/ trixie main\n')
+
+        async with BranchListServer(ServerOptions(latency=args.delay)) as server:
+            http = HttpClient()
+            cache = ResponseCache('bench', path.join(directory, 'cache'))
+            status_path = path.join(directory, 'status')
+
+            one_after_another = await time_rounds(args.rounds, sequential, http, status_path, cache, server.url, directory)
+            at_once = await time_rounds(args.rounds, concurrent, http, status_path, cache, server.url, directory)
+            await http.close()
+
+    print(json.dumps({
+        'delay_ms': args.delay * 1000,
+        'packages': args.packages,
+        'sequential_ms': round(one_after_another * 1000, 3),
+        'concurrent_ms': round(at_once * 1000, 3),
+        'saved_ms': round((one_after_another - at_once) * 1000, 3),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark running the refresh stages concurrently')
+    parser.add_argument('--delay', type=float, default=0.2)
+    parser.add_argument('--packages', type=int, default=5000)
+    parser.add_argument('--rounds', type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# A stand-in for the branch list server that can be made slow or broken on purpose. The benchmarks start it in-process,
+# and it can also be run on its own to point Branchy at with BRANCHY_BRANCH_LIST_URL.
+#
+# Usage: python3 bench/server.py [--port N] [--records N] [--latency SECONDS] [--fail-first N] [--fail-rate P]
+#                                [--stall-after BYTES]
+
+import asyncio
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+from hashlib import sha1
+from random import random
+
+from aiohttp import web
+
+PORT = 18416
+
+
+def make_branch_list(count: int, timestamp: int = 1700000000) -> bytes:
+    return b''.join(b'repo%d\nbranch%d\n%d\nrepo%d librepo%d\n1.0-%d\n' % (i % 50, i, timestamp + i, i % 50, i % 50, i)
+                    for i in range(count))
+
+
+@dataclass
+class ServerOptions:
+    records: int = 500
+    # Seconds to wait before answering.
+    latency: float = 0
+    # The first fail_first requests get a 503, and after that each one does with a chance of fail_rate.
+    fail_first: int = 0
+    fail_rate: float = 0
+    # Stop sending after this many bytes of the body and keep the connection open, like a server that hung.
+    stall_after: int = None
+
+
+@dataclass
+class ServerStats:
+    requests: int = 0
+    failures: int = 0
+    not_modified: int = 0
+    compressed: int = 0
+    connections: set = field(default_factory=set)
+
+
+class BranchListServer:
+    def __init__(self, options: ServerOptions = None, port: int = PORT):
+        self.options = options or ServerOptions()
+        self.port = port
+        self.url = f'http://127.0.0.1:{port}/get-branches'
+        self.stats = ServerStats()
+        self.set_body(make_branch_list(self.options.records))
+        self.runner = None
+
+    def set_body(self, body: bytes):
+        self.body = body
+        self.etag = f'"{sha1(body).hexdigest()}"'
+
+    async def get_branches(self, request: web.Request) -> web.StreamResponse:
+        self.stats.requests += 1
+        self.stats.connections.add(request.transport)
+
+        if self.options.latency:
+            await asyncio.sleep(self.options.latency)
+
+        if self.stats.requests <= self.options.fail_first or random() < self.options.fail_rate:
+            self.stats.failures += 1
+            return web.Response(status=503)
+
+        if request.headers.get('If-None-Match') == self.etag:
+            self.stats.not_modified += 1
+            return web.Response(status=304, headers={'ETag': self.etag})
+
+        if self.options.stall_after is not None:
+            response = web.StreamResponse(headers={'ETag': self.etag})
+            await response.prepare(request)
+            await response.write(self.body[:self.options.stall_after])
+            await asyncio.sleep(3600)
+            return response
+
+        response = web.Response(body=self.body, headers={'ETag': self.etag})
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            self.stats.compressed += 1
+            response.enable_compression()
+        return response
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/get-branches', self.get_branches)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+
+async def serve_forever(server: BranchListServer):
+    async with server:
+        print(f'Serving {server.options.records} records on {server.url}')
+        await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Serve a synthetic branch list')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--records', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--fail-first', type=int, default=0)
+    parser.add_argument('--fail-rate', type=float, default=0)
+    parser.add_argument('--stall-after', type=int, default=None)
+    args = parser.parse_args()
+
+    options = ServerOptions(args.records, args.latency, args.fail_first, args.fail_rate, args.stall_after)
+    asyncio.run(serve_forever(BranchListServer(options, args.port)))
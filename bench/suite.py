@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# Runs Branchy end to end against stand-ins for everything it talks to: a local branch list server, a temp
+# sources.list.d, a dpkg status file and dpkg-query, apt, apt-get and pkexec shims that print about as much as the real
+# ones. Times each stage for a range of branch list sizes and writes the results as JSON, which --compare checks
+# against the results from another commit.
+#
+# Usage: python3 bench/suite.py [--sizes N,N,...] [--rounds N] [--output FILE] [--compare FILE] [--no-ui]
+
+import asyncio
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+from datetime import datetime
+from os import chmod, environ, makedirs, path, unlink
+from statistics import median
+from sys import executable, stderr
+from sys import path as sys_path
+from time import perf_counter, sleep
+
+BENCH_DIR = path.dirname(path.abspath(__file__))
+ROOT_DIR = path.dirname(BENCH_DIR)
+sys_path.insert(0, ROOT_DIR)
+
+from server import PORT  # noqa: E402
+
+SIZES = (10, 100, 1000, 10000, 50000)
+# Installed packages other than the ones on the branch list, so the status file is the size of a phone's.
+OTHER_PACKAGES = 3000
+# A stage is only called slower or faster in --compare past this ratio, as timings move a bit from run to run.
+THRESHOLD = 1.2
+XVFB_DISPLAY = ':87'
+
+DPKG_QUERY_SHIM = f'''#!{executable}
+import sys
+from os import environ
+
+packages = int(environ.get('BENCH_PACKAGES', 0))
+versions = {{f'pkg{{i}}': f'{{i}}.0-1' for i in range({OTHER_PACKAGES})}}
+versions.update((f'{{name}}{{i}}', '1.0-0') for i in range(min(packages, 50)) for name in ('repo', 'librepo'))
+
+wanted = sys.argv[sys.argv.index('-W') + 1:] if '-W' in sys.argv else []
+for package in wanted or versions:
+    if package in versions:
+        print(package, versions[package])
+'''
+
+APT_SHIM = f'''#!{executable}
+import sys
+from os import environ
+
+args, skip = [], False
+for arg in sys.argv[1:]:
+    if skip:
+        skip = False
+    elif arg == '-o':
+        skip = True
+    elif not arg.startswith('-'):
+        args.append(arg)
+
+packages = args[1:]
+count = int(environ.get('BENCH_APT_PACKAGES', len(packages)))
+names = [package.split('=')[0] for package in packages] or [f'pkg{{i}}' for i in range(count)]
+names = (names * (count // max(len(names), 1) + 1))[:count]
+
+if args[:1] == ['update']:
+    for i, source in enumerate(('trixie', 'trixie-updates', 'trixie-security', 'experiments')):
+        print(f'Hit:{{i + 1}} http://repo.furios.io/ {{source}} InRelease')
+    print('Reading package lists... Done')
+elif args[:1] == ['install']:
+    print('Reading package lists... Done')
+    print('Building dependency tree... Done')
+    print('Reading state information... Done')
+    print('The following packages will be upgraded:')
+    print('  ' + ' '.join(names))
+    print(f'{{count}} upgraded, 0 newly installed, 0 to remove and 0 not upgraded.')
+    for i, name in enumerate(names):
+        print(f'Get:{{i + 1}} http://furilabs-{{name}}.repo.furios.io/trixie-main trixie/main arm64 {{name}} arm64 2.0-1 [{{i % 900 + 20}} kB]')
+    for name in names:
+        print(f'Preparing to unpack .../{{name}}_2.0-1_arm64.deb ...')
+        print(f'Unpacking {{name}} (2.0-1) over (1.0-0) ...')
+    for name in names:
+        print(f'Setting up {{name}} (2.0-1) ...')
+    print('Processing triggers for libc-bin (2.36-9) ...')
+'''
+
+PKEXEC_SHIM = '''#!/bin/sh
+exec "$@"
+'''
+
+
+def write_executable(file_path: str, content: str):
+    with open(file_path, 'w') as f:
+        f.write(content)
+    chmod(file_path, 0o755)
+
+
+def write_status_file(status_path: str, packages: int):
+    with open(status_path, 'w') as f:
+        for i in range(OTHER_PACKAGES):
+            f.write(f'Package: pkg{i}\nStatus: install ok installed\nArchitecture: all\nVersion: {i}.0-1\n'
+                    f'Description: synthetic package\n\n')
+        for i in range(min(packages, 50)):
+            for name in ('repo', 'librepo'):
+                f.write(f'Package: {name}{i}\nStatus: install ok installed\nArchitecture: all\nVersion: 1.0-0\n'
+                        f'Description: synthetic package\n\n')
+
+
+# Everything Branchy reads its paths from at import time points into directory, so this has to happen before the
+# first import of branchy.
+def setup_environment(directory: str):
+    bin_dir = path.join(directory, 'bin')
+    sources_dir = path.join(directory, 'sources.list.d')
+    for d in (bin_dir, sources_dir, path.join(directory, 'cache')):
+        makedirs(d)
+
+    write_executable(path.join(bin_dir, 'dpkg-query'), DPKG_QUERY_SHIM)
+    write_executable(path.join(bin_dir, 'apt'), APT_SHIM)
+    write_executable(path.join(bin_dir, 'apt-get'), APT_SHIM)
+    write_executable(path.join(bin_dir, 'pkexec'), PKEXEC_SHIM)
+
+    with open(path.join(sources_dir, 'furios.list'), 'w') as f:
+        f.write('deb http://furilabs-repo1.repo.furios.io/trixie-branch1/ trixie main\n')
+
+    environ['PATH'] = f"{bin_dir}:{environ['PATH']}"
+    environ['HOME'] = directory
+    environ['XDG_CACHE_HOME'] = path.join(directory, 'cache')
+    environ['BRANCHY_SOURCES_DIR'] = sources_dir
+    environ['BRANCHY_BRANCH_LIST_URL'] = f'http://127.0.0.1:{PORT}/get-branches'
+    environ.pop('BRANCHY_TRACE', None)
+
+
+def summarize(times: list[float]) -> dict:
+    return {'median_ms': round(median(times) * 1000, 3), 'min_ms': round(min(times) * 1000, 3)}
+
+
+async def time_rounds(rounds: int, function, *args) -> dict:
+    times = []
+    for _ in range(rounds):
+        started = perf_counter()
+        result = function(*args)
+        if asyncio.iscoroutine(result):
+            await result
+        times.append(perf_counter() - started)
+    return summarize(times)
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.check_output(['git', '-C', ROOT_DIR, 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# GTK needs a display. Without one, a virtual one is started if Xvfb is installed.
+def start_display():
+    if environ.get('DISPLAY') or environ.get('WAYLAND_DISPLAY'):
+        return None, None
+    if shutil.which('Xvfb') is None:
+        return None, 'no display, and Xvfb is not installed'
+
+    display = subprocess.Popen(['Xvfb', XVFB_DISPLAY, '-nolisten', 'tcp'], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    # It's ready once its socket is there.
+    for _ in range(50):
+        if path.exists(f'/tmp/.X11-unix/X{XVFB_DISPLAY[1:]}'):
+            break
+        sleep(0.1)
+    environ['DISPLAY'] = XVFB_DISPLAY
+    environ['GDK_BACKEND'] = 'x11'
+    return display, None
+
+
+def run_ui_bench(branch_list: str, rounds: int, list_view: bool) -> dict:
+    args = [executable, path.join(BENCH_DIR, 'ui.py'), '--branch-list', branch_list, '--rounds', str(rounds)]
+    if list_view:
+        args.append('--list-view')
+
+    result = subprocess.run(args, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {'error': result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f'exit {result.returncode}'}
+    return json.loads(result.stdout)
+
+
+async def bench_size(args, directory: str, size: int) -> dict:
+    from branchy.cache import CHUNK_SIZE
+    from branchy.parser import parse_branch_chunks
+    from branchy.packages import PackageState
+    from branchy.state import BranchState
+    from branchy.sys import apply_changes, generate_update_script, get_installed_package_versions, parse_branches, run_process
+    from branchy.utils import SOURCES_DIR, ENABLED_BRANCHES_NAME, ENABLED_BRANCHES_DEB822_NAME
+    from server import BranchListServer, ServerOptions, make_branch_list
+
+    # Each size starts without the branches the last one applied.
+    for name in (ENABLED_BRANCHES_NAME, ENABLED_BRANCHES_DEB822_NAME):
+        try:
+            unlink(path.join(SOURCES_DIR, name))
+        except OSError:
+            pass
+
+    environ['BENCH_PACKAGES'] = str(size)
+    status_path = path.join(directory, 'status')
+    write_status_file(status_path, size)
+
+    body = make_branch_list(size)
+    branch_list = path.join(directory, 'branches.txt')
+    with open(branch_list, 'wb') as f:
+        f.write(body)
+    chunks = [body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+
+    results = {'records': size, 'bytes': len(body)}
+
+    def parse():
+        parse_branches(BranchState(), parse_branch_chunks(chunks))
+
+    results['parse'] = await time_rounds(args.rounds, parse)
+
+    async with BranchListServer(ServerOptions(size)):
+        state = BranchState()
+
+        # Cold downloads and parses everything, warm gets a 304 and keeps what it has.
+        async def cold_refresh():
+            state.branch_list_cache.clear()
+            state.parsed_validator = None
+            state.package_state = PackageState(status_path)
+            await state.load()
+
+        async def warm_refresh():
+            await state.load()
+
+        results['refresh_cold'] = await time_rounds(args.rounds, cold_refresh)
+        results['refresh_warm'] = await time_rounds(args.rounds, warm_refresh)
+        results['installed_versions_dpkg_query'] = await time_rounds(args.rounds, get_installed_package_versions)
+        await state.close()
+
+    # Every repository moves to its newest branch.
+    for repo in list(state.repositories.values())[:50]:
+        state.enable(repo.name, repo.branches[0].name)
+    results['changes'] = len(state.changed_branches)
+    results['generate_update_script'] = await time_rounds(args.rounds, generate_update_script, state)
+
+    lines = []
+    results['apply'] = await time_rounds(args.rounds, apply_changes, state, lines.append)
+    results['apply']['lines'] = len(lines) // args.rounds
+
+    # What the progress dialog gets while apt installs as many packages as there are records.
+    lines.clear()
+    env = {**environ, 'BENCH_APT_PACKAGES': str(size)}
+    results['stream_output'] = await time_rounds(
+        args.rounds, run_process, ['apt', 'install', '-y'], lines.append, False, None, env)
+    results['stream_output']['lines'] = len(lines) // args.rounds
+
+    if not args.no_ui:
+        results['update_ui'] = args.ui_skipped or run_ui_bench(branch_list, args.rounds, False)
+        results['update_ui_list_view'] = args.ui_skipped or run_ui_bench(branch_list, args.rounds, True)
+
+    return results
+
+
+def compare(old: dict, new: dict) -> list[str]:
+    lines = []
+    for size, stages in new['results'].items():
+        old_stages = old['results'].get(size, {})
+        for stage, result in stages.items():
+            old_result = old_stages.get(stage)
+            if not isinstance(result, dict) or not isinstance(old_result, dict) or 'median_ms' not in result or 'median_ms' not in old_result:
+                continue
+
+            ratio = result['median_ms'] / old_result['median_ms'] if old_result['median_ms'] else 1
+            verdict = 'slower' if ratio > THRESHOLD else 'faster' if ratio < 1 / THRESHOLD else ''
+            lines.append(f"{size:>6} {stage:<32} {old_result['median_ms']:>10.3f}ms {result['median_ms']:>10.3f}ms "
+                         f"{ratio:>6.2f}x {verdict}")
+    return lines
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        setup_environment(directory)
+        display, reason = (None, None) if args.no_ui else start_display()
+        args.ui_skipped = {'skipped': reason} if reason else None
+
+        try:
+            results = {}
+            for size in args.sizes:
+                print(f"Running with {size} records", file=stderr)
+                results[str(size)] = await bench_size(args, directory, size)
+        finally:
+            if display is not None:
+                display.terminate()
+
+    report = {
+        'commit': get_commit(),
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'rounds': args.rounds,
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print(f"Compared with {old.get('commit')}:", file=stderr)
+        print('\n'.join(compare(old, report)), file=stderr)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark Branchy end to end against a local server and shimmed apt/dpkg')
+    parser.add_argument('--sizes', type=lambda s: [int(size) for size in s.split(',')], default=list(SIZES))
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--output', help='Write the results here instead of to stdout')
+    parser.add_argument('--compare', help='Results from an earlier run to compare with')
+    parser.add_argument('--no-ui', action='store_true', help='Skip the GTK benchmarks')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Times building the branch rows and searching them in a real window, with a branch list read from a file instead of
+# the network. Needs a display, which bench/suite.py provides with Xvfb when there isn't one.
+#
+# Usage: python3 bench/ui.py --branch-list FILE [--rounds N] [--list-view]
+
+import json
+from argparse import ArgumentParser
+from asyncio import create_task, get_running_loop
+from os import path
+from statistics import median
+from sys import path as sys_path
+from time import perf_counter
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import gi  # noqa: E402
+
+gi.require_version('Gtk', '4.0')
+gi.require_version('Adw', '1')
+
+from branchy import BranchyApp  # noqa: E402
+from branchy.loop import run_app  # noqa: E402
+from branchy.parser import parse_branch_chunks  # noqa: E402
+from branchy.sys import get_enabled_branches, load_enabled_branches, parse_branches  # noqa: E402
+from branchy.ui import after_next_frame  # noqa: E402
+
+QUERIES = ('repo1', 'repo12', 'branch', 'branch4', 'zzz', '')
+
+
+class BenchApp(BranchyApp):
+    def __init__(self, branch_list: str, rounds: int):
+        super().__init__()
+        self.branch_list = branch_list
+        self.rounds = rounds
+        self.results = {}
+
+    # Instead of refreshing from the network, the branch list from the file is put up.
+    def on_first_frame(self):
+        create_task(self.run_bench())
+
+    async def next_frame(self):
+        future = get_running_loop().create_future()
+        self.win.queue_draw()
+        after_next_frame(self.win, lambda: future.done() or future.set_result(None))
+        await future
+
+    async def time_to_frame(self, function) -> float:
+        started = perf_counter()
+        function()
+        await self.next_frame()
+        return perf_counter() - started
+
+    def search(self, query: str):
+        # The entry waits before searching, so its handler is held off and called here instead.
+        with self.search_entry.handler_block_by_func(self.on_search_changed):
+            self.search_entry.set_text(query)
+        self.on_search_changed(self.search_entry)
+
+    async def run_bench(self):
+        try:
+            with open(self.branch_list, 'rb') as f:
+                records = list(parse_branch_chunks([f.read()]))
+            parse_branches(self, records)
+            load_enabled_branches(self, *get_enabled_branches())
+
+            first = await self.time_to_frame(self.update_ui)
+            # Nothing has changed since, so these only reconcile.
+            again = [await self.time_to_frame(self.update_ui) for _ in range(self.rounds)]
+
+            search = {}
+            for query in QUERIES:
+                times = []
+                for _ in range(self.rounds):
+                    started = perf_counter()
+                    self.search(query)
+                    times.append(perf_counter() - started)
+                    self.search('')
+                search[query or 'cleared'] = round(median(times) * 1000, 3)
+
+            self.results = {
+                'records': len(records),
+                'rows': sum(len(repo.branches) for repo in self.repositories.values()),
+                'first_update_ms': round(first * 1000, 3),
+                'update_ms': round(median(again) * 1000, 3),
+                'search_ms': search,
+            }
+        except Exception as e:
+            self.results = {'error': str(e)}
+        finally:
+            self.quit()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark building and searching the branch rows')
+    parser.add_argument('--branch-list', required=True)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--list-view', action='store_true')
+    args = parser.parse_args()
+
+    app = BenchApp(args.branch_list, args.rounds)
+    run_app(app, ['branchy', '--list-view'] if args.list_view else ['branchy'])
+    print(json.dumps(app.results, indent=2))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Checks the apt update commands that the update script runs, for each kind of change, against the exact lines they
+# should be. The sources are written to a scratch directory, and the branch list is made up, so nothing here needs apt,
+# root or the network. Exits non-zero if any of them don't match.
+#
+# Usage: python3 bench/update_commands.py
+
+import json
+from os import environ, listdir, path, unlink
+from sys import exit, path as sys_path
+from tempfile import TemporaryDirectory
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+# The sources directory goes into the commands, and is read when branchy is imported.
+sources_directory = TemporaryDirectory()
+environ['BRANCHY_SOURCES_DIR'] = sources_directory.name
+
+from branchy.parser import parse_branch_chunks  # noqa: E402
+from branchy.sources import SourcesScanner  # noqa: E402
+from branchy.state import BranchState  # noqa: E402
+from branchy.sys import generate_apt_update_command, get_removed_branches, load_enabled_branches, parse_branches  # noqa: E402
+from branchy.utils import CODENAME, DEB_URL_TEMPLATE, SOURCES_DIR  # noqa: E402
+
+BRANCH_LIST = (
+    b'phosh\nmain\n1700000000\nphosh\n0.1\n'
+    b'phosh\nfix-thing\n1710000000\nphosh libphosh\n0.2\n'
+    b'bash\nnew-bash\n1720000000\nbash\n5.3\n'
+)
+
+UPDATE_ALL = 'apt update -y'
+
+
+def update(*sources: str) -> str:
+    updates = [f"apt-get update -o {source} -o Dir::Etc::sourceparts=- -o APT::Get::List-Cleanup=0" for source in sources]
+    return f"{' && '.join(updates)} || {UPDATE_ALL}"
+
+
+def sourcelist(filename: str) -> str:
+    return f'Dir::Etc::sourcelist={SOURCES_DIR}/{filename}'
+
+
+def one_line(repo: str, branch: str) -> str:
+    return f"deb {DEB_URL_TEMPLATE.format(repo=repo, codename=CODENAME, branch=branch)} {CODENAME} main\n"
+
+
+def deb822(repo: str, branch: str) -> str:
+    return f"Types: deb\nURIs: {DEB_URL_TEMPLATE.format(repo=repo, codename=CODENAME, branch=branch)}\nSuites: {CODENAME}\nComponents: main\n"
+
+
+# name: (sources files, installed versions, changes, the command they should come out as). A change is (repo, branch)
+# to enable that branch, or (repo, None) to disable the repository.
+CASES = {
+    'enable': (
+        {'furios.list': one_line('bash', 'main')},
+        {}, [('phosh', 'fix-thing')],
+        update(sourcelist('experiments.list')),
+    ),
+    'switch': (
+        {'experiments.list': one_line('phosh', 'main')},
+        {}, [('phosh', 'fix-thing')],
+        update(sourcelist('experiments.list')),
+    ),
+    'same branch update': (
+        {'experiments.list': one_line('phosh', 'main')},
+        {'phosh': '0.0'}, [('phosh', 'main')],
+        update(sourcelist('experiments.list')),
+    ),
+    'drop to system branch': (
+        {'furios.list': one_line('phosh', 'main'), 'experiments.list': one_line('phosh', 'fix-thing')},
+        {}, [('phosh', None)],
+        update(sourcelist('furios.list')),
+    ),
+    'switch to system branch': (
+        {'furios.list': one_line('phosh', 'main'), 'experiments.list': one_line('phosh', 'fix-thing')},
+        {}, [('phosh', 'main')],
+        update(sourcelist('furios.list')),
+    ),
+    'drop to deb822 system branch': (
+        {'furios.sources': deb822('phosh', 'main'), 'experiments.sources': deb822('phosh', 'fix-thing')},
+        {}, [('phosh', None)],
+        update(sourcelist('furios.sources')),
+    ),
+    'drop without system branch': (
+        {'experiments.list': one_line('phosh', 'fix-thing')},
+        {}, [('phosh', None)],
+        UPDATE_ALL,
+    ),
+    'mixed': (
+        {'furios.list': one_line('phosh', 'main'), 'experiments.list': one_line('phosh', 'fix-thing')},
+        {}, [('phosh', None), ('bash', 'new-bash')],
+        update(sourcelist('experiments.list'), sourcelist('furios.list')),
+    ),
+    'mixed with a drop without system branch': (
+        {'experiments.list': one_line('phosh', 'fix-thing')},
+        {}, [('bash', 'new-bash'), ('phosh', None)],
+        UPDATE_ALL,
+    ),
+    'enable in deb822': (
+        {'furios.sources': deb822('bash', 'main')},
+        {}, [('phosh', 'fix-thing')],
+        update(sourcelist('experiments.sources')),
+    ),
+    'system file name that needs quoting': (
+        {"furi os's.list": one_line('phosh', 'main'), 'experiments.list': one_line('phosh', 'fix-thing')},
+        {}, [('phosh', None)],
+        update(f"'Dir::Etc::sourcelist={SOURCES_DIR}/furi os'\"'\"'s.list'"),
+    ),
+}
+
+
+def write_sources(files: dict):
+    for filename in listdir(SOURCES_DIR):
+        unlink(path.join(SOURCES_DIR, filename))
+    for filename, content in files.items():
+        with open(path.join(SOURCES_DIR, filename), 'w') as f:
+            f.write(content)
+
+
+# The same steps as BranchState.load and the CLI's enable and disable, with the branch list and sources from above.
+def get_update_command(files: dict, installed_versions: dict, changes: list) -> str:
+    write_sources(files)
+
+    state = BranchState()
+    state.sources_scanner = SourcesScanner(SOURCES_DIR)
+    state.installed_versions = installed_versions
+    parse_branches(state, parse_branch_chunks([BRANCH_LIST]))
+    load_enabled_branches(state, *state.sources_scanner.get_branches())
+    state.changed_branches = get_removed_branches(state)
+
+    for repo, branch in changes:
+        if branch is None:
+            state.disable(repo)
+        else:
+            state.enable(repo, branch)
+
+    return generate_apt_update_command(state)
+
+
+if __name__ == '__main__':
+    results = {}
+    with sources_directory:
+        for name, (files, installed_versions, changes, expected) in CASES.items():
+            command = get_update_command(files, installed_versions, changes)
+            results[name] = {'ok': command == expected, 'command': command}
+            if command != expected:
+                results[name]['expected'] = expected
+
+    print(json.dumps(results, indent=2))
+    exit(0 if all(result['ok'] for result in results.values()) else 1)
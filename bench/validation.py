@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Times branch record validation on a synthetic get-branches payload, one record at a time against whole batches.
+#
+# Usage: python3 bench/validation.py [--records N] [--rounds N]
+
+import json
+from argparse import ArgumentParser
+from os import path
+from statistics import median
+from sys import path as sys_path
+from time import perf_counter
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from branchy.parser import parse_branch_chunks  # noqa: E402
+from branchy.utils import validate_branch_data, validate_branch_records  # noqa: E402
+
+
+def generate_records(count: int) -> list[tuple[str, str, str, str]]:
+    return [(f'repo{i % 200}', f'feature-{i}', ' '.join(f'pkg{i % 200}-{j}' for j in range(i % 8 + 1)), f'{i}.0-1+furios~{i % 3}')
+            for i in range(count)]
+
+
+def generate_payload(records: list[tuple[str, str, str, str]]) -> bytes:
+    return ''.join(f'{repo}\n{branch}\n{1700000000 + i}\n{packages}\n{version}\n'
+                   for i, (repo, branch, packages, version) in enumerate(records)).encode('utf-8')
+
+
+def time_rounds(rounds: int, function) -> float:
+    times = []
+    for _ in range(rounds):
+        started = perf_counter()
+        function()
+        times.append(perf_counter() - started)
+    return median(times)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark branch record validation')
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    records = generate_records(args.records)
+    payload = generate_payload(records)
+
+    def per_record():
+        for repo, branch, packages, version in records:
+            validate_branch_data(repo, branch, packages.split(' '), version)
+
+    per_record_time = time_rounds(args.rounds, per_record)
+    batch_time = time_rounds(args.rounds, lambda: validate_branch_records(records))
+    parse_time = time_rounds(args.rounds, lambda: list(parse_branch_chunks([payload[i:i + 65536] for i in range(0, len(payload), 65536)])))
+
+    print(json.dumps({
+        'records': args.records,
+        'payload_bytes': len(payload),
+        'per_record_ms': round(per_record_time * 1000, 3),
+        'batch_ms': round(batch_time * 1000, 3),
+        'speedup': round(per_record_time / batch_time, 1),
+        'full_parse_ms': round(parse_time * 1000, 3),
+    }, indent=2))
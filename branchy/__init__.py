@@ -1,3 +1,9 @@
-from .branchy import BranchyApp
-
 __all__ = ['BranchyApp']
+
+
+# BranchyApp pulls in GTK, which the model and the rest of the non-UI code don't need, so it's only imported on use.
+def __getattr__(name):
+    if name == 'BranchyApp':
+        from .branchy import BranchyApp
+        return BranchyApp
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -2,13 +2,22 @@ from asyncio import create_task
 from collections import OrderedDict
 from typing import Dict, Tuple
 
-from gi.repository import Gtk, Adw
+from gi.repository import GLib, Gtk, Adw
 
+from .cache import ResponseCache
+from .http import HttpClient
+from .metrics import metrics
 from .repository import Repository
-from .ui import setup_window, setup_header_bar, setup_content, update_ui, setup_progress_dialog
-from .sys import refresh_branches, apply_changes, get_installed_package_versions
-from .utils import show_toast, show_results
-from sys import exit
+from .scheduler import SingleFlight
+from .search import SearchIndex, is_refinement
+from .sources import SourcesScanner
+from .startup import startup_profile
+from .ui import setup_window, setup_header_bar, setup_content, update_ui, update_repo_rows, reset_changed_repos, setup_progress_dialog, restore_scroll_position, apply_search, after_next_frame, TerminalWriter, RepoCard, ReconcileStats, show_toast, show_results
+from .packages import PackageState
+from sys import exit, stderr
+
+# The list view and everything that talks to apt, dpkg and the network are imported where they're first used, so
+# they don't hold up the first frame.
 
 
 class BranchyApp(Adw.Application):
@@ -20,38 +29,157 @@ class BranchyApp(Adw.Application):
         self.initial_branches: Dict[str, str] = {}
         self.system_branches: Dict[str, Tuple[str, str]] = {}
         self.installed_versions: Dict[str, str] = {}
-
-    def clear(self):
-        self.repositories.clear()
-        self.enabled_branches.clear()
-        self.system_branches.clear()
-        self.changed_branches.clear()
-        self.initial_branches.clear()
-        self.apply_button.set_sensitive(False)
+        self.package_state = PackageState()
+        self.branch_list_cache = ResponseCache('branches')
+        self.http = HttpClient()
+        self.sources_scanner = SourcesScanner()
+        self.parsed_validator = None
+        self.repo_cards: Dict[str, RepoCard] = OrderedDict()
+        self.radios: Dict[Tuple[str, str], Gtk.CheckButton] = {}
+        self.reconcile_stats = ReconcileStats()
+        self.scroll_position = 0.0
+        self.scroll_handler = None
+        self.list_view_mode = False
+        self.search_index = SearchIndex(self.repositories)
+        self.search_text = ''
+        self.search_visible = None
+        self.profile_startup = False
+        # Everything that wants the branches refreshed goes through this, so there's never more than one refresh
+        # touching the repositories at a time.
+        self.refresh = SingleFlight(self.refresh_branches)
+        self.apt_simulator = None
+        self.state_monitor = None
+
+        self.add_main_option('list-view', 0, GLib.OptionFlags.NONE, GLib.OptionArg.NONE,
+                             'Build branch rows lazily as they scroll into view', None)
+        self.add_main_option('profile-startup', 0, GLib.OptionFlags.NONE, GLib.OptionArg.NONE,
+                             'Print how long each phase of startup took and quit once the branches are shown', None)
+        self.add_main_option('debug', 0, GLib.OptionFlags.NONE, GLib.OptionArg.NONE,
+                             'Record timings and counters, and show them in a debug panel', None)
+
+    def do_handle_local_options(self, options):
+        if options.contains('list-view'):
+            self.list_view_mode = True
+        if options.contains('profile-startup'):
+            self.profile_startup = True
+        if options.contains('debug'):
+            metrics.enable()
+        return -1
 
     def do_activate(self):
-        self.win = setup_window(self)
-        self.win.connect('close-request', lambda _: exit(0))
-        self.header_bar, self.search_entry, self.apply_button = setup_header_bar(self)
-        self.content_box, self.scrolled, self.spinner = setup_content(self)
-
-        create_task(self.refresh_branches())
-        self.win.present()
+        with startup_profile.phase('do_activate'):
+            with startup_profile.phase('setup_window'):
+                self.win = setup_window(self)
+                self.win.connect('close-request', lambda _: exit(0))
+            with startup_profile.phase('setup_header_bar'):
+                self.header_bar, self.search_entry, self.apply_button = setup_header_bar(self)
+            with startup_profile.phase('setup_content'):
+                self.content_box, self.scrolled, self.spinner = setup_content(self)
+
+            if self.list_view_mode:
+                with startup_profile.phase('setup_list_view'):
+                    from .listview import setup_list_view
+                    self.content_box = setup_list_view(self)
+                    self.scrolled.set_child(self.content_box)
+
+            self.show_loading_screen()
+            self.win.present()
+
+        # Loading branches only starts once the spinner is on screen, rather than competing with the first frame.
+        after_next_frame(self.win, self.on_first_frame)
+
+    def on_first_frame(self):
+        startup_profile.mark('first frame')
+        self.refresh()
+
+        from .monitor import StateMonitor
+        self.state_monitor = StateMonitor(self)
+        self.state_monitor.start()
 
     async def refresh_branches(self):
+        with startup_profile.phase('refresh_branches'):
+            await self.load_branches()
+
+        if not startup_profile.finished:
+            # Wait for whatever the refresh changed to be painted. Nothing may have, so make sure there is a frame.
+            self.win.queue_draw()
+            after_next_frame(self.win, self.finish_startup_profile)
+
+    # Nothing on the app is reset until the new branches are in, so if loading them fails, what was shown before can
+    # be put back. With the retries, that can take a couple of minutes to happen.
+    async def load_branches(self):
         self.show_loading_screen()
-        self.clear()
+
+        with startup_profile.phase('import sys'):
+            from .sys import refresh_branches
+
+        # Installed versions are read while the branch list loads. They're only needed once it's time to show it.
+        installed_versions = create_task(self.package_state.get_installed_versions())
 
         try:
-            self.installed_versions = await get_installed_package_versions()
-            await refresh_branches(self)
+            # On the first refresh we paint whatever we had cached straight away, and only touch the UI again if the
+            # server has something newer.
+            with startup_profile.phase('cached branches'):
+                from_cache = not self.repositories and await refresh_branches(self, from_cache=True)
+
+            if not from_cache:
+                with startup_profile.phase('fetch branches'):
+                    await refresh_branches(self)
+
+            with startup_profile.phase('installed versions'):
+                self.installed_versions = await installed_versions
             self.update_ui()
+
+            if from_cache:
+                try:
+                    with startup_profile.phase('revalidate branches'):
+                        changed = await refresh_branches(self, only_if_changed=True)
+                    if changed:
+                        self.update_ui()
+                except Exception as e:
+                    self.show_toast(f"Couldn't check for new branches: {str(e)}")
         except Exception as e:
+            if self.repositories:
+                self.update_ui()
+            else:
+                self.hide_loading_screen()
             self.show_results("Uh oh", f"Error refreshing branches: {str(e)}")
+        finally:
+            installed_versions.cancel()
+
+    def finish_startup_profile(self):
+        report = startup_profile.finish()
+        if self.profile_startup:
+            print(report, file=stderr)
+            self.quit()
 
     def update_ui(self):
-        update_ui(self)
-        self.hide_loading_screen()
+        with startup_profile.phase('update_ui'), metrics.span('update_ui'):
+            if self.list_view_mode:
+                from .listview import update_list_model
+                self.reconcile_stats = update_list_model(self)
+            else:
+                self.reconcile_stats = update_ui(self)
+            self.hide_loading_screen()
+        metrics.count('widgets_built', self.reconcile_stats.created)
+
+        if not startup_profile.finished:
+            after_next_frame(self.win, lambda: startup_profile.mark('frame with branches'))
+
+        # The index was rebuilt and new rows may have been created, so the next search has to look at every row.
+        self.search_text, self.search_visible = '', None
+        if self.search_entry.get_text():
+            self.on_search_changed(self.search_entry)
+
+    # For when the sources or installed versions of just these repositories changed underneath us.
+    def update_repos(self, repos):
+        with metrics.span('update_repos', repos=len(repos)):
+            if self.list_view_mode:
+                from .listview import update_list_repos
+                update_list_repos(self, repos)
+            else:
+                update_repo_rows(self, repos)
+            reset_changed_repos(self, repos)
 
     def get_affected_packages(self):
         affected_packages = []
@@ -82,7 +210,7 @@ class BranchyApp(Adw.Application):
         dialog = Adw.MessageDialog(
             transient_for=self.win,
             heading="Apply Branches?",
-            body=f"{affected_packages}",
+            body=f"{affected_packages}\n\nWorking out what installing would do…",
         )
 
         dialog.add_response("cancel", "Nah")
@@ -93,6 +221,20 @@ class BranchyApp(Adw.Application):
         dialog.connect('response', self.on_apply_response)
         dialog.present()
 
+        create_task(self.show_apt_plan(dialog, affected_packages))
+
+    async def show_apt_plan(self, dialog, affected_packages):
+        if self.apt_simulator is None:
+            from .plan import AptSimulator
+            self.apt_simulator = AptSimulator()
+
+        try:
+            plan = await self.apt_simulator.get_plan(self)
+            dialog.set_body(f"{affected_packages}\n\nUpdate and Install:\n{plan}")
+        except Exception as e:
+            print(e)
+            dialog.set_body(f"{affected_packages}\n\nCouldn't work out what installing would do.")
+
     def on_apply_response(self, dialog, response_id):
         if response_id == "update":
             create_task(self.apply_changes())
@@ -101,27 +243,29 @@ class BranchyApp(Adw.Application):
 
     async def apply_changes(self, also_install=False):
         dialog, title, terminal, close_button = setup_progress_dialog(self, "Workin’ on it…")
-        buff = terminal.get_buffer()
+        writer = TerminalWriter(terminal)
         dialog.present()
 
-        def append_to_terminal(line):
-            buff.insert_at_cursor(line.decode('utf-8'))
-            terminal.scroll_to_mark(buff.get_insert(), 0.0, False, 0.0, 1.0)
-
         try:
-            await apply_changes(self, output_stream_callback=append_to_terminal)
+            from .sys import apply_changes
+            await apply_changes(self, output_stream_callback=writer.write, also_install=also_install)
             title.set_text("Everything went well!")
-            await self.refresh_branches()
+            await self.refresh()
         except Exception as e:
             print(e)
             title.set_text("Uh oh!")
-            append_to_terminal(f"\n\nError applying changes: {str(e)}")
+            writer.write(f"\n\nError applying changes: {str(e)}")
         finally:
             close_button.set_sensitive(True)
 
     def show_loading_screen(self):
+        if self.content_box.get_parent() is not None:
+            self.scroll_position = self.scrolled.get_vadjustment().get_value()
+
         self.scrolled.set_child(self.spinner)
         self.spinner.start()
+        # The changes are gone through again once the branches are back, so there's nothing to apply until then.
+        self.apply_button.set_sensitive(False)
 
         self.content_box.set_opacity(0)
 
@@ -130,32 +274,25 @@ class BranchyApp(Adw.Application):
         self.scrolled.set_child(self.content_box)
 
         self.content_box.set_opacity(1)
+        restore_scroll_position(self)
 
     def on_search_changed(self, search_entry):
-        search_text = search_entry.get_text().lower()
-        for child in self.content_box:
-            self.search_recursively(child, search_text)
-
-    def search_recursively(self, widget, search_text, force_visible=False):
-        if isinstance(widget, Adw.PreferencesGroup):
-            repo_title = widget.get_title().lower()
-            visible_children = not search_text or search_text in repo_title
-            for child in widget:
-                if self.search_recursively(child, search_text, force_visible=visible_children):
-                    visible_children = True
-            widget.set_visible(visible_children)
-            return visible_children
-        elif isinstance(widget, Adw.ActionRow):
-            row_visible = force_visible or not search_text or search_text in widget.get_title().lower()
-            widget.set_visible(row_visible)
-            return row_visible
-        elif isinstance(widget, Gtk.Widget):
-            visible_children = force_visible
-            for child in widget:
-                if self.search_recursively(child, search_text, force_visible):
-                    visible_children = True
-            return visible_children
-        return force_visible
+        search_text = search_entry.get_text().strip().lower()
+        visible = self.search_index.search(search_text)
+
+        if self.list_view_mode:
+            from .listview import filter_list
+            if is_refinement(self.search_text, search_text):
+                change = Gtk.FilterChange.MORE_STRICT
+            elif is_refinement(search_text, self.search_text):
+                change = Gtk.FilterChange.LESS_STRICT
+            else:
+                change = Gtk.FilterChange.DIFFERENT
+            filter_list(self, visible, change)
+        else:
+            apply_search(self, visible, self.search_visible)
+
+        self.search_text, self.search_visible = search_text, visible
 
     def on_branch_toggled(self, radio, repo, branch_object):
         classes = ' '.join(radio.get_css_classes())
@@ -190,10 +327,11 @@ class BranchyApp(Adw.Application):
         # If this branch has an "update-needed" radio button, we need to toggle it off manually too. We can reset it to its
         # update-needed-delete state, so if the user selects it again, we go back to the original state.
         for other_branch in self.repositories[repo].branches:
-            if 'update-needed' in ' '.join(other_branch.radio.get_css_classes()):
-                other_branch.radio.set_css_classes(['update-needed-delete'])
-                other_branch.radio.set_active(False)
-                other_branch.radio.set_inconsistent(False)
+            other_radio = self.radios[(repo, other_branch.name)]
+            if 'update-needed' in ' '.join(other_radio.get_css_classes()):
+                other_radio.set_css_classes(['update-needed-delete'])
+                other_radio.set_active(False)
+                other_radio.set_inconsistent(False)
                 self.changed_branches[repo] = (other_branch.name, None)
 
         # If we are the system branch and we are already enabled, we do nothing
@@ -230,20 +368,18 @@ class BranchyApp(Adw.Application):
             # Ensure the system branch is selected if it's available.
             if repo in self.system_branches:
                 system_branch, _ = self.system_branches[repo]
-                for other_branch in self.repositories[repo].branches:
-                    if other_branch.name == system_branch:
-                        other_branch.radio.set_active(True)
+                other_branch = self.repositories[repo].branches_by_name.get(system_branch)
+                if other_branch is not None:
+                    self.radios[(repo, system_branch)].set_active(True)
 
-                        if repo in self.enabled_branches:
-                            del self.enabled_branches[repo]
-
-                        initial_branch = self.initial_branches.get(repo)
-                        if initial_branch is not None:
-                            self.changed_branches[repo] = (initial_branch, None)
-                        else:
-                            self.changed_branches.pop(repo, None)
+                    if repo in self.enabled_branches:
+                        del self.enabled_branches[repo]
 
-                        break
+                    initial_branch = self.initial_branches.get(repo)
+                    if initial_branch is not None:
+                        self.changed_branches[repo] = (initial_branch, None)
+                    else:
+                        self.changed_branches.pop(repo, None)
 
         self.apply_button.set_sensitive(bool(self.changed_branches))
 
@@ -0,0 +1,137 @@
+import json
+from dataclasses import dataclass
+from os import environ, makedirs, path, replace, unlink
+from tempfile import mkstemp
+from typing import Dict, Iterator, Optional
+
+CACHE_DIR = path.join(environ.get('XDG_CACHE_HOME') or path.expanduser('~/.cache'), 'branchy')
+CHUNK_SIZE = 1 << 16
+
+
+@dataclass
+class CacheEntry:
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @property
+    def validator(self) -> Optional[str]:
+        return self.etag or self.last_modified
+
+    def conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    def __init__(self, name: str, directory: str = CACHE_DIR):
+        self.body_path = path.join(directory, f'{name}.txt')
+        self.meta_path = path.join(directory, f'{name}.json')
+
+    def load(self) -> Optional[CacheEntry]:
+        if not path.exists(self.body_path):
+            return None
+
+        try:
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        return CacheEntry(meta.get('etag'), meta.get('last_modified'))
+
+    def read_chunks(self) -> Iterator[bytes]:
+        with open(self.body_path, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                yield chunk
+
+    def clear(self):
+        for file_path in (self.meta_path, self.body_path):
+            try:
+                unlink(file_path)
+            except OSError:
+                pass
+
+    def writer(self, entry: CacheEntry) -> 'CacheWriter':
+        return CacheWriter(self, entry)
+
+
+class CacheWriter:
+    # Writes a response to the cache as it streams in. Nothing replaces the cached copy unless the whole body made it,
+    # and failing to write to the cache never fails the request itself.
+    def __init__(self, cache: ResponseCache, entry: CacheEntry):
+        self.cache = cache
+        self.entry = entry
+        self.temp_path = None
+        self.file = None
+
+    def __enter__(self):
+        try:
+            makedirs(path.dirname(self.cache.body_path), exist_ok=True)
+            fd, self.temp_path = make_temp_file(self.cache.body_path)
+            self.file = open(fd, 'wb')
+        except IOError as e:
+            print(f"Error caching response: {e}")
+        return self
+
+    def write(self, chunk: bytes):
+        if self.file is None:
+            return
+
+        try:
+            self.file.write(chunk)
+        except IOError as e:
+            print(f"Error caching response: {e}")
+            self.discard()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.file is None:
+            return
+
+        if exc_type is not None:
+            self.discard()
+            return
+
+        try:
+            self.file.close()
+            self.file = None
+            # The body goes first, so a crash in between can only leave validators that are too old, never too new.
+            replace(self.temp_path, self.cache.body_path)
+            write_atomically(self.cache.meta_path, json.dumps({'etag': self.entry.etag, 'last_modified': self.entry.last_modified}))
+        except IOError as e:
+            print(f"Error caching response: {e}")
+            self.discard()
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.temp_path is not None:
+            remove_temp_file(self.temp_path)
+
+
+# Next to the file it's going to replace, so the replace stays on one filesystem. The app and the background check can
+# write the same file at the same time, so each write gets a name of its own instead of both writing into one.
+def make_temp_file(file_path: str) -> tuple[int, str]:
+    return mkstemp(dir=path.dirname(file_path), prefix=f'{path.basename(file_path)}.', suffix='.tmp')
+
+
+def remove_temp_file(temp_path: str):
+    try:
+        unlink(temp_path)
+    except OSError:
+        pass
+
+
+def write_atomically(file_path: str, content: str):
+    fd, temp_path = make_temp_file(file_path)
+    try:
+        with open(fd, 'w') as f:
+            f.write(content)
+        replace(temp_path, file_path)
+    except BaseException:
+        remove_temp_file(temp_path)
+        raise
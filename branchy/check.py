@@ -0,0 +1,109 @@
+import json
+from os import listdir, makedirs, path
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from .cache import CACHE_DIR, write_atomically
+from .packages import get_file_stamp
+from .sources import is_sources_file
+from .sys import refresh_branches
+
+# What the last check saw, so the next one can tell whether anything changed.
+CHECK_PATH = path.join(CACHE_DIR, 'check.json')
+NOTIFICATION_ID = 'updates'
+# More than this and the notification only says how many others there are.
+MAX_NOTIFIED_UPDATES = 5
+
+
+class CheckResult(NamedTuple):
+    updates: Dict[str, Tuple[str, str]]
+    # The ones that weren't there at the last check, which are the only ones worth telling anyone about.
+    new_updates: Dict[str, Tuple[str, str]]
+
+
+def load_check_state() -> Dict:
+    try:
+        with open(CHECK_PATH, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_check_state(check_state: Dict):
+    makedirs(CACHE_DIR, exist_ok=True)
+    write_atomically(CHECK_PATH, json.dumps(check_state))
+
+
+# File stamps the way they come back from the JSON, so they can be compared with what the last check saved.
+def get_stamp(file_path: str) -> Optional[list]:
+    stamp = get_file_stamp(file_path)
+    return list(stamp) if stamp is not None else None
+
+
+def get_sources_stamps(sources_dir: str) -> list:
+    return [[name, get_stamp(path.join(sources_dir, name))] for name in sorted(listdir(sources_dir)) if is_sources_file(name)]
+
+
+# The branches we're on that have a newer version than what's installed, as repo: (installed, available).
+def get_updates(state) -> Dict[str, Tuple[str, str]]:
+    return {repo: (state.installed_versions.get(repo), state.repositories[repo].branches_by_name[branch].version)
+            for repo, branch in state.initial_branches.items() if state.needs_update(repo)}
+
+
+# Checks for updates to the branches we're on, the way the app would when it starts. Returns None without reading
+# anything else if neither the branch list, the sources nor the installed packages changed since the last check. The
+# branch list goes into the same cache as the app's, so opening it afterwards doesn't wait on the network.
+async def check_for_updates(state) -> Optional[CheckResult]:
+    last = load_check_state()
+    stamps = {
+        'sources': get_sources_stamps(state.sources_scanner.sources_dir),
+        'status': get_stamp(state.package_state.status_path),
+    }
+
+    state.parsed_validator = last.get('validator')
+    if not await refresh_branches(state):
+        if all(stamp == last.get(name) for name, stamp in stamps.items()):
+            return None
+
+        state.parsed_validator = None
+        await refresh_branches(state, from_cache=True)
+
+    state.installed_versions = await state.package_state.get_installed_versions()
+    updates = get_updates(state)
+
+    save_check_state({'validator': state.parsed_validator, **stamps, 'updates': updates})
+    previous = last.get('updates', {})
+    return CheckResult(updates, {repo: update for repo, update in updates.items() if list(update) != previous.get(repo)})
+
+
+def format_updates(updates: Dict[str, Tuple[str, str]]) -> str:
+    lines = [f"{repo}: {installed} → {available}" for repo, (installed, available) in
+             list(updates.items())[:MAX_NOTIFIED_UPDATES]]
+    if len(updates) > MAX_NOTIFIED_UPDATES:
+        lines.append(f"and {len(updates) - MAX_NOTIFIED_UPDATES} more")
+    return '\n'.join(lines)
+
+
+# Posted through Gio, which is all the GUI libraries this needs. Without it, there's only the output.
+def send_notification(updates: Dict[str, Tuple[str, str]]) -> bool:
+    try:
+        from gi.repository import Gio, GLib
+    except ImportError as e:
+        print(f"Error sending notification: {e}")
+        return False
+
+    title = "Branch update available" if len(updates) == 1 else f"{len(updates)} branch updates available"
+    notification = Gio.Notification.new(title)
+    notification.set_body(format_updates(updates))
+    notification.set_icon(Gio.ThemedIcon.new('io.furios.Branchy'))
+
+    try:
+        # Non-unique, so this doesn't take the app's name on the bus or hand the notification to a running instance.
+        app = Gio.Application(application_id='io.furios.Branchy', flags=Gio.ApplicationFlags.NON_UNIQUE)
+        app.register(None)
+        app.send_notification(NOTIFICATION_ID, notification)
+        # The notification is sent asynchronously, and we're about to exit.
+        Gio.bus_get_sync(Gio.BusType.SESSION, None).flush_sync(None)
+    except GLib.Error as e:
+        print(f"Error sending notification: {e}")
+        return False
+    return True
@@ -0,0 +1,259 @@
+import json
+from argparse import ArgumentParser
+from asyncio import run
+from contextlib import nullcontext, redirect_stdout
+from os import environ, makedirs, path, unlink
+from sys import stdout, stderr
+from typing import Dict, Optional
+
+from .cache import write_atomically
+from .state import BranchState
+from .sys import apply_changes
+from .utils import get_time_ago
+
+# Changes made with enable and disable are kept here until they're applied. Unlike the cache, they can't be fetched
+# again if they're cleared.
+STATE_DIR = path.join(environ.get('XDG_STATE_HOME') or path.expanduser('~/.local/state'), 'branchy')
+PENDING_PATH = path.join(STATE_DIR, 'pending.json')
+
+
+def load_pending() -> Dict[str, Optional[str]]:
+    try:
+        with open(PENDING_PATH, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_pending(state: BranchState):
+    pending = {repo: new_branch for repo, (_, new_branch) in state.changed_branches.items()}
+    if pending:
+        makedirs(STATE_DIR, exist_ok=True)
+        write_atomically(PENDING_PATH, json.dumps(pending))
+    else:
+        clear_pending()
+
+
+def clear_pending():
+    if path.exists(PENDING_PATH):
+        unlink(PENDING_PATH)
+
+
+async def load_state(args, state: BranchState):
+    await state.load(cached=args.cached)
+
+    for repo, branch in load_pending().items():
+        try:
+            if branch is None:
+                state.disable(repo)
+            else:
+                state.enable(repo, branch)
+        except ValueError as e:
+            print(f"Dropping pending change: {e}", file=stderr)
+
+
+def print_json(data):
+    json.dump(data, stdout, indent=2)
+    stdout.write('\n')
+
+
+async def list_branches(args, state: BranchState) -> int:
+    await load_state(args, state)
+    visible = state.search_index.search(args.query) if args.query else None
+
+    repos = []
+    for repo, repository in state.repositories.items():
+        system_branch = state.system_branches.get(repo, (None, None))[0]
+        branches = [{
+            'name': branch.name,
+            'timestamp': branch.timestamp,
+            'version': branch.version,
+            'packages': list(branch.packages),
+            'enabled': state.enabled_branches.get(repo) == branch.name,
+            'system': branch.name == system_branch,
+        } for branch in repository.branches if visible is None or (repo, branch.name) in visible]
+
+        if branches:
+            repos.append({'repo': repo, 'branches': branches})
+
+    if args.json:
+        print_json(repos)
+        return 0
+
+    for repo in repos:
+        print(repo['repo'])
+        for branch in repo['branches']:
+            marker = '*' if branch['enabled'] else 's' if branch['system'] else ' '
+            print(f"  {marker} {branch['name']}  {branch['version']}  {get_time_ago(branch['timestamp'])}")
+
+    return 0
+
+
+async def show_status(args, state: BranchState) -> int:
+    await load_state(args, state)
+    return print_status(args, state)
+
+
+def print_status(args, state: BranchState) -> int:
+    status = state.get_status()
+
+    if args.json:
+        print_json(status)
+        return 0
+
+    for repo, info in status.items():
+        line = f"{repo}: {info['branch'] or '(none)'}"
+        if info['source']:
+            line += f" (from {info['source']})"
+        if info['update_needed']:
+            line += f", installed {info['installed_version']}, available {info['available_version']}"
+        if info['change']:
+            old_branch, new_branch = info['change']
+            line += f", pending {old_branch or '(none)'} → {new_branch or '(none)'}"
+        print(line)
+
+    return 0
+
+
+async def enable_branches(args, state: BranchState) -> int:
+    await load_state(args, state)
+
+    for spec in args.branches:
+        repo, _, branch = spec.partition('=')
+        if not branch:
+            raise ValueError(f"Expected repo=branch, got: {spec}")
+        state.enable(repo, branch)
+
+    save_pending(state)
+    return print_status(args, state) if not args.json else print_changes(state)
+
+
+async def disable_branches(args, state: BranchState) -> int:
+    await load_state(args, state)
+
+    for repo in args.repos:
+        state.disable(repo)
+
+    save_pending(state)
+    return print_status(args, state) if not args.json else print_changes(state)
+
+
+def print_changes(state: BranchState) -> int:
+    print_json({repo: list(change) for repo, change in state.changed_branches.items()})
+    return 0
+
+
+async def show_plan(args, state: BranchState) -> int:
+    from .plan import AptSimulator
+
+    await load_state(args, state)
+    plan = await AptSimulator().get_plan(state)
+
+    if args.json:
+        print_json({
+            'packages': [package._asdict() for package in plan.packages],
+            'download_size': plan.download_size,
+            'size_change': plan.size_change,
+        })
+        return 0
+
+    for package in plan.packages:
+        print(f"{package.action} {package.name} {package.old_version or ''} → {package.new_version or ''}")
+    print(plan)
+    return 0
+
+
+async def apply(args, state: BranchState) -> int:
+    await load_state(args, state)
+    if not state.changed_branches:
+        print("Nothing to apply", file=stderr)
+        return 0
+
+    # With --json, stdout is kept for the result and apt's output goes to stderr instead.
+    output = stderr.buffer if args.json else stdout.buffer
+
+    def write_output(line: bytes):
+        output.write(line)
+        output.flush()
+
+    await apply_changes(state, output_stream_callback=write_output, also_install=args.install)
+    clear_pending()
+
+    if args.json:
+        print_changes(state)
+    return 0
+
+
+async def check_updates(args, state: BranchState) -> int:
+    # Imported here since only this one command needs it.
+    from .check import check_for_updates, format_updates, send_notification
+
+    result = await check_for_updates(state)
+    if result is not None and result.new_updates and args.notify:
+        send_notification(result.new_updates)
+
+    if args.json:
+        print_json({
+            'changed': result is not None,
+            'updates': result.updates if result is not None else None,
+            'new_updates': result.new_updates if result is not None else None,
+        })
+    elif result is None:
+        print("Nothing changed since the last check")
+    elif result.updates:
+        print(format_updates(result.updates))
+    else:
+        print("No updates")
+    return 0
+
+
+async def run_command(args) -> int:
+    state = BranchState()
+    try:
+        # The rest of Branchy prints its errors, which mustn't end up in the middle of the JSON. The JSON itself goes
+        # to the stdout imported above, which this doesn't touch.
+        with redirect_stdout(stderr) if args.json else nullcontext():
+            return await args.handler(args, state)
+    finally:
+        await state.close()
+
+
+def main(argv: list[str]) -> int:
+    parser = ArgumentParser(prog='branchy', description='Manage FuriOS feature branches')
+    parser.add_argument('--json', action='store_true', help='print machine readable output')
+    parser.add_argument('--cached', action='store_true', help="use the cached branch list if there is one")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = commands.add_parser('list', help='list the available branches')
+    list_parser.add_argument('query', nargs='?', help='only show repos, branches and packages matching this')
+    list_parser.set_defaults(handler=list_branches)
+
+    status_parser = commands.add_parser('status', help='show enabled branches and pending changes')
+    status_parser.set_defaults(handler=show_status)
+
+    enable_parser = commands.add_parser('enable', help='enable branches, to be applied later')
+    enable_parser.add_argument('branches', nargs='+', metavar='repo=branch')
+    enable_parser.set_defaults(handler=enable_branches)
+
+    disable_parser = commands.add_parser('disable', help='disable the branch of repos, to be applied later')
+    disable_parser.add_argument('repos', nargs='+', metavar='repo')
+    disable_parser.set_defaults(handler=disable_branches)
+
+    plan_parser = commands.add_parser('plan', help='simulate installing the pending changes')
+    plan_parser.set_defaults(handler=show_plan)
+
+    apply_parser = commands.add_parser('apply', help='apply pending changes')
+    apply_parser.add_argument('--install', action='store_true', help='also install the packages from the new branches')
+    apply_parser.set_defaults(handler=apply)
+
+    check_parser = commands.add_parser('check', help='check the enabled branches for updates, e.g. from a timer')
+    check_parser.add_argument('--notify', action='store_true', help='post a desktop notification for new updates')
+    check_parser.set_defaults(handler=check_updates)
+
+    args = parser.parse_args(argv)
+
+    try:
+        return run(run_command(args))
+    except Exception as e:
+        print(f"branchy: {e}", file=stderr)
+        return 1
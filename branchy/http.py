@@ -0,0 +1,102 @@
+from asyncio import TimeoutError, sleep
+from random import uniform
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from .metrics import metrics
+
+# No timeout at all for the whole request, since the branch list can be large on a slow connection. These only fire
+# when the server goes quiet.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+# Retries after the first attempt. The delay before each doubles from RETRY_DELAY up to RETRY_MAX_DELAY, half of it
+# random so that clients that failed together don't come back together.
+RETRIES = 3
+RETRY_DELAY = 0.5
+RETRY_MAX_DELAY = 8
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+# How long an idle connection is kept around for the next refresh.
+KEEPALIVE_TIMEOUT = 300
+
+T = TypeVar('T')
+
+
+class HttpStatusError(Exception):
+    def __init__(self, url: str, status: int):
+        super().__init__(f"Failed to fetch {url}: HTTP {status}")
+        self.status = status
+
+
+def get_accept_encoding(compress: bool = True) -> str:
+    if not compress:
+        return 'identity'
+
+    # aiohttp only decodes brotli if one of these is around.
+    for module in ('brotli', 'brotlicffi'):
+        try:
+            __import__(module)
+            return 'gzip, deflate, br'
+        except ImportError:
+            pass
+    return 'gzip, deflate'
+
+
+def get_retry_delay(attempt: int, delay: float = RETRY_DELAY, max_delay: float = RETRY_MAX_DELAY) -> float:
+    delay = min(delay * 2 ** attempt, max_delay)
+    return delay / 2 + uniform(0, delay / 2)
+
+
+def is_retryable(e: Exception) -> bool:
+    from aiohttp import ClientConnectionError, ClientPayloadError
+
+    if isinstance(e, HttpStatusError):
+        return e.status in RETRY_STATUSES
+    return isinstance(e, (ClientConnectionError, ClientPayloadError, TimeoutError))
+
+
+# One session for as long as the app is around, so refreshes reuse the connection and DNS lookup of the last one.
+class HttpClient:
+    def __init__(self, connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT,
+                 retries: int = RETRIES, retry_delay: float = RETRY_DELAY, compress: bool = True):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.compress = compress
+        self.session = None
+        self.attempts = 0
+
+    # aiohttp takes a while to import and isn't needed until we actually go to the network.
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+            self.session = ClientSession(
+                connector=TCPConnector(keepalive_timeout=KEEPALIVE_TIMEOUT),
+                timeout=ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=self.read_timeout),
+                headers={'Accept-Encoding': get_accept_encoding(self.compress)},
+            )
+        return self.session
+
+    def get(self, url: str, headers: Optional[Dict[str, str]] = None):
+        return self.get_session().get(url, headers=headers)
+
+    # Retries the whole of function, so it should do the request and read the response, and be fine to run again.
+    async def retry(self, function: Callable[[], Awaitable[T]]) -> T:
+        attempt = 0
+        while True:
+            self.attempts += 1
+            try:
+                return await function()
+            except Exception as e:
+                if attempt >= self.retries or not is_retryable(e):
+                    raise
+                print(f"Error fetching, retrying: {e}")
+                metrics.mark('http_retry', error=str(e))
+
+            await sleep(get_retry_delay(attempt, self.retry_delay))
+            attempt += 1
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
@@ -0,0 +1,209 @@
+from gi.repository import Gio, GObject, Gtk, Adw
+
+from .metrics import metrics
+from .ui import ReconcileStats, get_row_state, create_warning_button, reset_changed_branches
+
+
+class RepoItem(GObject.Object):
+    def __init__(self, name: str):
+        super().__init__()
+        self.name = name
+
+
+class BranchItem(GObject.Object):
+    active = GObject.Property(type=bool, default=False)
+    inconsistent = GObject.Property(type=bool, default=False)
+    sensitive = GObject.Property(type=bool, default=True)
+    css_classes = GObject.Property(type=GObject.TYPE_STRV)
+
+    def __init__(self, repo: str, branch, group: list['BranchItem']):
+        super().__init__()
+        self.repo = repo
+        self.branch = branch
+        self.group = group
+        self.subtitle = ''
+        self.warning = None
+
+    # Rows are only built while they're on screen, so BranchyApp.on_branch_toggled talks to the item instead of the
+    # radio button. These mirror the bits of the Gtk.CheckButton API it uses, including the radio group behaviour.
+    def get_active(self) -> bool:
+        return self.active
+
+    def set_active(self, active: bool):
+        if active:
+            for other in self.group:
+                if other is not self and other.active:
+                    other.active = False
+        self.active = active
+
+    def set_inconsistent(self, inconsistent: bool):
+        self.inconsistent = inconsistent
+
+    def set_sensitive(self, sensitive: bool):
+        self.sensitive = sensitive
+
+    def get_css_classes(self) -> list[str]:
+        return list(self.css_classes or [])
+
+    def set_css_classes(self, css_classes: list[str]):
+        self.css_classes = css_classes
+
+
+def setup_list_view(app) -> Gtk.ListView:
+    app.branch_store = Gio.ListStore(item_type=GObject.Object)
+    app.branch_filter_visible = None
+    app.branch_filter = Gtk.CustomFilter.new(lambda item: is_item_visible(app, item))
+
+    factory = Gtk.SignalListItemFactory()
+    factory.connect('setup', on_setup, app)
+    factory.connect('bind', on_bind, app)
+    factory.connect('unbind', on_unbind)
+
+    filter_model = Gtk.FilterListModel(model=app.branch_store, filter=app.branch_filter)
+    list_view = Gtk.ListView(model=Gtk.NoSelection(model=filter_model), factory=factory)
+    list_view.set_margin_start(24)
+    list_view.set_margin_end(24)
+
+    return list_view
+
+
+def on_setup(factory, list_item, app):
+    box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+
+    header = Gtk.Label(xalign=0)
+    header.add_css_class('heading')
+    header.set_margin_top(24)
+    header.set_margin_bottom(12)
+    box.append(header)
+
+    row = Adw.ActionRow()
+    row.add_css_class('card')
+    box.append(row)
+
+    radio = Gtk.CheckButton()
+    # A group is what makes a check button look like a radio button. Each row gets its own, since exclusivity is
+    # handled by BranchItem.set_active.
+    radio.set_group(Gtk.CheckButton())
+    row.add_suffix(radio)
+
+    click_controller = radio.observe_controllers()[0]
+    if click_controller:
+        radio.remove_controller(click_controller)
+
+    click_controller = Gtk.GestureClick()
+    click_controller.connect('released', lambda *_: on_row_released(app, list_item))
+    row.add_controller(click_controller)
+
+    box.header, box.row, box.radio = header, row, radio
+    box.warning_button, box.bindings = None, []
+    list_item.set_child(box)
+    metrics.count('widgets_built')
+
+
+def on_bind(factory, list_item, app):
+    box, item = list_item.get_child(), list_item.get_item()
+
+    is_header = isinstance(item, RepoItem)
+    box.header.set_visible(is_header)
+    box.row.set_visible(not is_header)
+    list_item.set_activatable(False)
+
+    if is_header:
+        box.header.set_label(item.name)
+        return
+
+    box.row.set_title(item.branch.name)
+    box.row.set_subtitle(item.subtitle)
+
+    flags = GObject.BindingFlags.SYNC_CREATE
+    box.bindings = [
+        item.bind_property('active', box.radio, 'active', flags),
+        item.bind_property('inconsistent', box.radio, 'inconsistent', flags),
+        item.bind_property('sensitive', box.radio, 'sensitive', flags),
+        item.bind_property('css-classes', box.radio, 'css-classes', flags),
+    ]
+
+    if item.warning is not None:
+        box.warning_button = create_warning_button(app, *item.warning)
+        box.row.add_prefix(box.warning_button)
+
+
+def on_unbind(factory, list_item):
+    box = list_item.get_child()
+
+    for binding in box.bindings:
+        binding.unbind()
+    box.bindings = []
+
+    if box.warning_button is not None:
+        box.row.remove(box.warning_button)
+        box.warning_button = None
+
+
+def on_row_released(app, list_item):
+    item = list_item.get_item()
+    if isinstance(item, BranchItem):
+        app.on_branch_toggled(item, item.repo, item.branch)
+
+
+def update_list_model(app) -> ReconcileStats:
+    items = []
+    app.radios.clear()
+    for repo, repository in app.repositories.items():
+        items.extend(create_repo_items(app, repo, repository))
+
+    app.branch_store.splice(0, app.branch_store.get_n_items(), items)
+    reset_changed_branches(app)
+
+    # Rows are built by the list view as they scroll into view, so nothing here counts as a widget.
+    return ReconcileStats()
+
+
+def create_repo_items(app, repo, repository) -> list[GObject.Object]:
+    items = [RepoItem(repo)]
+
+    group = []
+    for branch in repository.branches:
+        item = BranchItem(repo, branch, group)
+        group.append(item)
+
+        state = get_row_state(app, repo, branch)
+        item.subtitle, item.warning = state.subtitle, state.warning
+        item.set_css_classes(['update-needed-untouched'] if state.warning else [])
+        item.set_inconsistent(state.warning is not None)
+        item.set_sensitive(state.sensitive)
+        item.set_active(state.active)
+
+        app.radios[(repo, branch.name)] = item
+        items.append(item)
+
+    return items
+
+
+# Subtitles and warnings are only read when a row is bound, so the items of each repository are swapped out for new
+# ones rather than changed in place.
+def update_list_repos(app, repos):
+    position = 0
+    while position < app.branch_store.get_n_items():
+        # Every repository is a header followed by its branches, in the same order as app.repositories.
+        repo = app.branch_store.get_item(position).name
+        repository = app.repositories.get(repo)
+        count = 1 + (len(repository.branches) if repository is not None else 0)
+
+        if repo in repos and repository is not None:
+            app.branch_store.splice(position, count, create_repo_items(app, repo, repository))
+        position += count
+
+
+def filter_list(app, visible, change: Gtk.FilterChange):
+    app.branch_filter_visible = visible
+    app.branch_filter.changed(change)
+
+
+def is_item_visible(app, item) -> bool:
+    visible = app.branch_filter_visible
+    if visible is None:
+        return True
+    if isinstance(item, RepoItem):
+        return item.name in visible
+    return (item.repo, item.branch.name) in visible
@@ -0,0 +1,44 @@
+from asyncio import run, set_event_loop_policy, sleep
+
+from gi.repository import GLib
+
+
+def run_app(app, argv: list[str]) -> int:
+    try:
+        from gi.events import GLibEventLoopPolicy
+    except ImportError:
+        # PyGObject older than 3.50 has no asyncio integration, so all we can do is pump the GLib main context by hand.
+        return run(pump_gtk_events(app, argv))
+
+    # asyncio runs on top of the GLib main loop, so both GTK events and asyncio callbacks are dispatched from the same
+    # poll() call and the process sleeps for as long as there is nothing to do.
+    set_event_loop_policy(GLibEventLoopPolicy())
+    return app.run(argv)
+
+
+# Without app.run() nothing parses the command line, so the options are picked out of argv here and handed to the app
+# the way GApplication would. Only flags are understood, which is all the app has. Anything else, --help included, is
+# ignored.
+def parse_flag_options(args: list[str]) -> GLib.VariantDict:
+    options = GLib.VariantDict.new(None)
+    for arg in args:
+        if arg.startswith('--') and len(arg) > 2:
+            options.insert_value(arg[2:], GLib.Variant('b', True))
+    return options
+
+
+async def pump_gtk_events(app, argv: list[str], interval: float = 1 / 160) -> int:
+    main_context = GLib.MainContext.default()
+
+    # Same as with app.run(), a status of 0 or more means the app is done.
+    status = app.do_handle_local_options(parse_flag_options(argv[1:]))
+    if status >= 0:
+        return status
+
+    app.register()
+    app.activate()
+
+    while True:
+        while main_context.pending():
+            main_context.iteration(False)
+        await sleep(interval)
@@ -0,0 +1,142 @@
+import atexit
+import json
+from asyncio import current_task
+from collections import deque
+from contextlib import nullcontext
+from os import environ, getpid
+from threading import current_thread
+from time import perf_counter_ns
+from typing import Dict, Optional
+from weakref import WeakKeyDictionary
+
+# Set to a file path to record metrics and write them there as a Chrome trace on exit, for chrome://tracing or
+# https://ui.perfetto.dev.
+TRACE_PATH = environ.get('BRANCHY_TRACE')
+# Old events are dropped past this, so a long running session can't grow without bound.
+MAX_TRACE_EVENTS = 100000
+
+# What span() hands out while disabled. Entering and leaving it does nothing.
+NULL_SPAN = nullcontext()
+
+
+class SpanStats:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, duration: int):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+
+class Span:
+    __slots__ = ('metrics', 'name', 'args', 'start')
+
+    def __init__(self, metrics: 'Metrics', name: str, args: Dict):
+        self.metrics = metrics
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = repr(exc_value)
+        self.metrics.add_span(self.name, self.start, perf_counter_ns(), self.args)
+
+
+# Timing spans and counters for the hot paths. Disabled, every call returns straight away, so they can stay in the
+# code for good.
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.spans: Dict[str, SpanStats] = {}
+        self.counters: Dict[str, int] = {}
+        self.events = deque(maxlen=MAX_TRACE_EVENTS)
+        # By task or thread, and only for as long as it's around, so neither the tracks nor an id that gets reused can
+        # pile unrelated events onto one track. Numbers aren't handed out twice.
+        self.tracks: WeakKeyDictionary = WeakKeyDictionary()
+        self.last_track = 0
+        self.start = perf_counter_ns()
+
+    def enable(self, trace_path: Optional[str] = None):
+        if not self.enabled:
+            self.enabled = True
+            self.start = perf_counter_ns()
+        if trace_path:
+            atexit.register(self.write_trace, trace_path)
+
+    def span(self, name: str, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def count(self, name: str, n: int = 1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+        self.events.append({'name': name, 'ph': 'C', 'ts': self.get_timestamp(perf_counter_ns()), 'pid': getpid(),
+                            'args': {name: self.counters[name]}})
+
+    def mark(self, name: str, **args):
+        if not self.enabled:
+            return
+        self.events.append({'name': name, 'ph': 'i', 's': 't', 'ts': self.get_timestamp(perf_counter_ns()),
+                            'pid': getpid(), 'tid': self.get_track(), 'args': args})
+
+    def add_span(self, name: str, start: int, end: int, args: Dict):
+        self.spans.setdefault(name, SpanStats()).add(end - start)
+        self.events.append({'name': name, 'ph': 'X', 'ts': self.get_timestamp(start), 'dur': (end - start) / 1000,
+                            'pid': getpid(), 'tid': self.get_track(), 'args': args})
+
+    def get_timestamp(self, ns: int) -> float:
+        return (ns - self.start) / 1000
+
+    # Spans in different tasks overlap without nesting, which trace viewers can't draw on one track. So every task,
+    # and every thread outside of one, gets a track of its own.
+    def get_track(self) -> int:
+        try:
+            task = current_task()
+        except RuntimeError:
+            task = None
+        key = task if task is not None else current_thread()
+
+        track = self.tracks.get(key)
+        if track is None:
+            self.last_track += 1
+            track = self.tracks[key] = self.last_track
+            name = task.get_name() if task is not None else key.name
+            self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': getpid(), 'tid': track, 'args': {'name': name}})
+        return track
+
+    def get_trace(self) -> Dict:
+        return {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+
+    def write_trace(self, trace_path: str):
+        try:
+            with open(trace_path, 'w') as f:
+                json.dump(self.get_trace(), f)
+        except IOError as e:
+            print(f"Error writing trace: {e}")
+
+    def get_summary(self) -> str:
+        lines = [f"{'span':<28} {'count':>6} {'total':>10} {'max':>10}"]
+        for name, stats in sorted(self.spans.items(), key=lambda item: -item[1].total):
+            lines.append(f"{name:<28} {stats.count:>6} {stats.total / 1e6:>8.1f}ms {stats.max / 1e6:>8.1f}ms")
+
+        lines.append('')
+        lines.append(f"{'counter':<28} {'value':>6}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<28} {value:>6}")
+        return '\n'.join(lines)
+
+
+metrics = Metrics()
+if TRACE_PATH:
+    metrics.enable(TRACE_PATH)
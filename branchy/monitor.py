@@ -0,0 +1,100 @@
+from asyncio import get_running_loop, wait
+from typing import Set
+
+from gi.repository import Gio, GLib
+
+from .metrics import metrics
+from .packages import get_changed_packages
+from .scheduler import SingleFlight
+from .sources import is_sources_file
+from .sys import patch_enabled_branches
+
+# apt, dpkg and editors tend to write a file several times in a row, so changes are only picked up once they've been
+# quiet for this long.
+SETTLE_DELAY = 0.2
+
+
+# Watches the sources and the dpkg status file, so that an apt upgrade or an edit to the sources behind our back shows
+# up without a refresh. Only the files that changed are read again, and only the rows of the repositories they affect
+# are touched.
+class StateMonitor:
+    def __init__(self, app):
+        self.app = app
+        self.changed_sources: Set[str] = set()
+        self.packages_changed = False
+        self.monitors = []
+        self.timer = None
+        self.sync = SingleFlight(self.sync_changes)
+
+    def start(self):
+        watches = (
+            (Gio.File.new_for_path(self.app.sources_scanner.sources_dir).monitor_directory, self.on_sources_changed),
+            (Gio.File.new_for_path(self.app.package_state.status_path).monitor_file, self.on_status_changed),
+        )
+        for monitor_path, callback in watches:
+            try:
+                monitor = monitor_path(Gio.FileMonitorFlags.WATCH_MOVES, None)
+            except GLib.Error as e:
+                print(f"Error watching for changes: {e}")
+                continue
+
+            monitor.set_rate_limit(int(SETTLE_DELAY * 1000))
+            monitor.connect('changed', callback)
+            # Monitors stop as soon as they're garbage collected.
+            self.monitors.append(monitor)
+
+    def stop(self):
+        for monitor in self.monitors:
+            monitor.cancel()
+        self.monitors = []
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def on_sources_changed(self, monitor, file, other_file, event):
+        # A rename can take a file out of the sources or put one in, so both ends of it count.
+        for changed_file in (file, other_file):
+            if changed_file is not None and is_sources_file(changed_file.get_basename()):
+                self.changed_sources.add(changed_file.get_basename())
+                self.schedule()
+
+    def on_status_changed(self, *_):
+        self.packages_changed = True
+        self.schedule()
+
+    def schedule(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = get_running_loop().call_later(SETTLE_DELAY, self.on_settled)
+
+    def on_settled(self):
+        self.timer = None
+        self.sync()
+
+    async def sync_changes(self):
+        # A refresh that's running may or may not have seen these changes, so they go on top of it once it's done.
+        while self.app.refresh.running is not None:
+            await wait([self.app.refresh.running])
+
+        changed_sources, self.changed_sources = self.changed_sources, set()
+        packages_changed, self.packages_changed = self.packages_changed, False
+        repos = set()
+
+        with metrics.span('sync_changes', sources=len(changed_sources), packages=packages_changed):
+            if changed_sources:
+                # The scanner would miss a change that leaves a file the same size within the same mtime tick, so
+                # the files we know changed are read again regardless.
+                for filename in changed_sources:
+                    self.app.sources_scanner.forget(filename)
+                branches = await get_running_loop().run_in_executor(None, self.app.sources_scanner.get_branches)
+                repos |= patch_enabled_branches(self.app, *branches)
+
+            if packages_changed:
+                # dpkg rewrites the whole status file, so that has to be read again. What changes on the app is only
+                # the packages whose versions did.
+                versions = await self.app.package_state.get_installed_versions()
+                repos |= get_changed_packages(self.app.installed_versions, versions) & self.app.repositories.keys()
+                self.app.installed_versions = versions
+
+        if repos:
+            self.app.update_repos(repos)
@@ -0,0 +1,126 @@
+from asyncio import get_running_loop
+from os import stat, path
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from .metrics import metrics
+
+DPKG_STATUS_PATH = '/var/lib/dpkg/status'
+
+
+def get_file_stamp(file_path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = stat(file_path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def get_package_name(binary_package: str) -> str:
+    return binary_package.split(':', 1)[0]
+
+
+def iter_stanzas(f, chunk_size: int = 1 << 16):
+    rest = ''
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+
+        data = rest + data
+        end = data.rfind('\n\n')
+        if end < 0:
+            rest = data
+            continue
+
+        yield from data[:end].split('\n\n')
+        rest = data[end + 2:]
+
+    if rest.strip():
+        yield rest
+
+
+# Names of the packages whose installed version differs between two snapshots, including any that came or went.
+def get_changed_packages(old_versions: Dict[str, str], new_versions: Dict[str, str]) -> Set[str]:
+    return {get_package_name(package) for package in old_versions.keys() | new_versions.keys()
+            if old_versions.get(package) != new_versions.get(package)}
+
+
+def get_field(stanza: str, name: str) -> Optional[str]:
+    # Continuation lines start with whitespace, so a newline followed by the name can only be the start of the field.
+    start = stanza.find(f'\n{name}:')
+    if start < 0:
+        return None
+
+    start += len(name) + 2
+    end = stanza.find('\n', start)
+    return stanza[start:end if end >= 0 else None].strip()
+
+
+def read_dpkg_status(status_path: str = DPKG_STATUS_PATH) -> Dict[str, str]:
+    # Gives the same result as `dpkg-query -W -f '${binary:Package} ${Version}\n'`, without the subprocess. The file is
+    # read in chunks and we only look for the handful of fields we need, rather than going through it line by line.
+    packages = []
+    native_arch = None
+
+    with open(status_path, 'r', encoding='utf-8', errors='replace') as f:
+        for stanza in iter_stanzas(f):
+            stanza = f'\n{stanza}'
+
+            package = get_field(stanza, 'Package')
+            if package is None or (get_field(stanza, 'Status') or '').endswith(' not-installed'):
+                continue
+
+            arch = get_field(stanza, 'Architecture')
+            # dpkg is always of the native architecture, which we need to tell which packages are foreign.
+            if package == 'dpkg':
+                native_arch = arch
+
+            packages.append((package, arch, get_field(stanza, 'Multi-Arch'), get_field(stanza, 'Version') or ''))
+
+    versions = {}
+    for package, arch, multi_arch, version in packages:
+        # binary:Package is arch-qualified for Multi-Arch: same packages and for packages of a foreign architecture.
+        if multi_arch == 'same' or (native_arch is not None and arch not in (native_arch, 'all', None)):
+            package = f"{package}:{arch}"
+
+        versions[package] = version
+
+    return versions
+
+
+class PackageState:
+    def __init__(self, status_path: str = DPKG_STATUS_PATH):
+        self.status_path = status_path
+        self.versions: Dict[str, str] = {}
+        self.names: Dict[str, list[str]] = {}
+        self.stamp = None
+
+    # dpkg rewrites its status file on every change, so as long as that looks the same the last snapshot is still good.
+    async def get_installed_versions(self) -> Dict[str, str]:
+        stamp = get_file_stamp(self.status_path)
+        if stamp is None or stamp != self.stamp:
+            with metrics.span('read_installed_versions'):
+                self.versions = await self.read_installed_versions()
+            self.stamp = stamp
+
+            self.names = {}
+            for package in self.versions:
+                self.names.setdefault(get_package_name(package), []).append(package)
+        return self.versions
+
+    async def read_installed_versions(self) -> Dict[str, str]:
+        # dpkg keeps the previous status file around as status-old, which is good enough if the current one is gone
+        # or unreadable. If neither works, dpkg-query may still know better.
+        for status_path in (self.status_path, f'{self.status_path}-old'):
+            try:
+                return await get_running_loop().run_in_executor(None, read_dpkg_status, status_path)
+            except (IOError, UnicodeError) as e:
+                print(f"Error reading {status_path}: {e}")
+
+        from .sys import get_installed_package_versions
+        return await get_installed_package_versions(admindir=path.dirname(self.status_path))
+
+    # Same as get_installed_package_versions(packages): arch-qualified names like libfoo:arm64 match libfoo.
+    async def get_installed_subset(self, packages: Iterable[str]) -> Dict[str, str]:
+        versions = await self.get_installed_versions()
+        return {package: versions[package] for name in packages for package in self.names.get(name, [])}
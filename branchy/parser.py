@@ -0,0 +1,91 @@
+from sys import intern
+from typing import Dict, Iterable, Iterator, Tuple
+
+from .metrics import metrics
+from .repository import Branch
+from .utils import InvalidBranchData, validate_branch_records
+
+# Every branch in the get-branches payload is a record of this many lines: repo, branch, timestamp, packages, version.
+RECORD_LINES = 5
+
+BranchRecord = Tuple[str, Branch]
+
+
+class BranchRecordParser:
+    def __init__(self):
+        self.buffer = b''
+        self.lines: list[str] = []
+        self.line_number = 0
+        self.record_number = 0
+        self.errors: list[tuple[int, str]] = []
+        # Many branches ship the same set of packages, so they all share a single tuple of them.
+        self.package_lists: Dict[str, tuple[str, ...]] = {}
+
+    # Takes a chunk of the payload as it comes in and returns the records it completed. Only the current record and
+    # the unfinished line at the end of the chunk are held on to.
+    def feed(self, chunk: bytes) -> list[BranchRecord]:
+        data = self.buffer + chunk
+        end = data.rfind(b'\n') + 1
+        self.buffer = data[end:]
+        return self.make_records(self.add_lines(data[:end].decode('utf-8', errors='replace').split('\n')[:-1]))
+
+    # Invalid records don't stop the parse, they're all reported together once we get to the end.
+    def close(self) -> list[BranchRecord]:
+        records = self.make_records(self.add_lines([self.buffer.decode('utf-8', errors='replace')])) if self.buffer.strip() else []
+        self.buffer = b''
+
+        if self.lines:
+            self.errors.append((self.record_number + 1, f"Truncated at line {self.line_number}, "
+                                                        f"expected {RECORD_LINES} lines but got {len(self.lines)}"))
+        if self.errors:
+            raise InvalidBranchData(sorted(self.errors))
+
+        return records
+
+    def add_lines(self, lines: list[str]) -> list[list[str]]:
+        completed = []
+        for line in lines:
+            self.line_number += 1
+            line = line.strip()
+
+            # Records never contain empty lines, so an empty line between two of them is just padding.
+            if not line and not self.lines:
+                continue
+
+            self.lines.append(line)
+            if len(self.lines) == RECORD_LINES:
+                completed.append(self.lines)
+                self.lines = []
+
+        return completed
+
+    def make_records(self, batch: list[list[str]]) -> list[BranchRecord]:
+        first_record_number = self.record_number + 1
+        self.record_number += len(batch)
+
+        try:
+            validate_branch_records([(repo, branch, packages, version) for repo, branch, _, packages, version in batch], first_record_number)
+            invalid = set()
+        except InvalidBranchData as e:
+            self.errors.extend(e.errors)
+            invalid = {number for number, _ in e.errors}
+
+        records = []
+        for number, (repo_name, branch_name, timestamp, packages, version) in enumerate(batch, first_record_number):
+            if not timestamp.isdigit():
+                self.errors.append((number, f"Invalid timestamp: {timestamp}"))
+            elif number not in invalid:
+                package_list = self.package_lists.get(packages)
+                if package_list is None:
+                    package_list = self.package_lists[packages] = tuple(intern(package) for package in packages.split(' '))
+                records.append((intern(repo_name), Branch(branch_name, int(timestamp), package_list, version)))
+
+        metrics.count('records_parsed', len(records))
+        return records
+
+
+def parse_branch_chunks(chunks: Iterable[bytes]) -> Iterator[BranchRecord]:
+    parser = BranchRecordParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
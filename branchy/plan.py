@@ -0,0 +1,220 @@
+from asyncio import Lock, Task, create_task, get_running_loop
+from dataclasses import dataclass, field
+from os import environ, listdir, makedirs, path, symlink, unlink
+from re import compile
+from typing import Dict, FrozenSet, NamedTuple, Optional, Tuple
+
+from .cache import CACHE_DIR
+from .sys import ERROR_TAIL_LINES, get_apt_install_lists, get_changed_sources, get_sources, run_process
+from .sources import is_enabled_branches_file
+from .utils import format_size
+
+# Where the simulation keeps its own copy of apt's state, so it can run without root and without touching the system's.
+APT_DIR = path.join(CACHE_DIR, 'apt')
+SYSTEM_LISTS_DIR = '/var/lib/apt/lists'
+# apt's output is parsed, so it mustn't be translated.
+APT_ENV = {**environ, 'LC_ALL': 'C'}
+
+INST_RE = compile(r'^Inst (\S+) (?:\[(\S+)\] )?\((\S+) ')
+REMV_RE = compile(r'^Remv (\S+)(?: \[(\S+)\])?')
+SECTION_RE = compile(r'^The following (.+):$')
+
+ACTIONS = ('install', 'upgrade', 'downgrade', 'reinstall', 'remove')
+ACTION_NAMES = {
+    'install': 'newly installed',
+    'upgrade': 'upgraded',
+    'downgrade': 'downgraded',
+    'reinstall': 'reinstalled',
+    'remove': 'removed',
+}
+
+
+class PlannedPackage(NamedTuple):
+    action: str
+    name: str
+    old_version: Optional[str]
+    new_version: Optional[str]
+
+
+@dataclass
+class AptPlan:
+    packages: list[PlannedPackage] = field(default_factory=list)
+    download_size: int = 0
+    size_change: int = 0
+
+    def count(self, action: str) -> int:
+        return sum(1 for package in self.packages if package.action == action)
+
+    def __str__(self):
+        if not self.packages:
+            return "No packages will change."
+
+        counts = ', '.join(f"{self.count(action)} {ACTION_NAMES[action]}" for action in ACTIONS if self.count(action))
+        if self.size_change >= 0:
+            disk = f"{format_size(self.size_change)} more disk space"
+        else:
+            disk = f"{format_size(-self.size_change)} of disk space freed"
+        return f"{counts}\n{format_size(self.download_size)} to download, {disk}"
+
+
+def parse_apt_simulation(output: str) -> list[PlannedPackage]:
+    packages = []
+    downgraded = set()
+    section = None
+
+    for line in output.splitlines():
+        if match := SECTION_RE.match(line):
+            section = match.group(1)
+        elif line.startswith('  ') and section is not None:
+            if 'DOWNGRADED' in section:
+                downgraded.update(name.split(':')[0] for name in line.split())
+        elif match := INST_RE.match(line):
+            name, old_version, new_version = match.groups()
+            if old_version is None:
+                action = 'install'
+            elif old_version == new_version:
+                action = 'reinstall'
+            elif name.split(':')[0] in downgraded:
+                action = 'downgrade'
+            else:
+                action = 'upgrade'
+            packages.append(PlannedPackage(action, name, old_version, new_version))
+        elif match := REMV_RE.match(line):
+            name, old_version = match.groups()
+            packages.append(PlannedPackage('remove', name, old_version, None))
+        else:
+            section = None
+
+    return packages
+
+
+# Sizes from apt-cache show, by package and version: download size in bytes and installed size in KiB.
+def parse_package_sizes(output: str) -> Dict[Tuple[str, str], Tuple[int, int]]:
+    sizes = {}
+    for stanza in output.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in stanza.splitlines() if ': ' in line and not line.startswith(' '))
+        key = (fields.get('Package'), fields.get('Version'))
+        if None not in key and key not in sizes:
+            sizes[key] = (int(fields.get('Size', 0)), int(fields.get('Installed-Size', 0)))
+    return sizes
+
+
+def get_plan_key(app) -> FrozenSet:
+    return frozenset(app.changed_branches.items())
+
+
+# Works out what applying the changes would install, with apt-get -s against the sources the changes would leave
+# behind. Plans are kept per set of changes until the branch list, the sources or the installed packages change.
+class AptSimulator:
+    def __init__(self, directory: str = APT_DIR, system_lists_dir: str = SYSTEM_LISTS_DIR):
+        self.sources_dir = path.join(directory, 'sources.list.d')
+        self.lists_dir = path.join(directory, 'lists')
+        self.cache_dir = path.join(directory, 'cache')
+        self.system_lists_dir = system_lists_dir
+        self.plans: Dict[FrozenSet, Task] = {}
+        self.state = None
+        # There's one copy of apt's state for all the simulations, so only one of them can use it at a time.
+        self.lock = Lock()
+
+    # Everyone asking about the same changes shares one simulation, even while it's still running.
+    def get_plan(self, app) -> Task:
+        state = (app.parsed_validator, app.package_state.stamp,
+                 frozenset(app.initial_branches.items()), frozenset(app.system_branches.items()))
+        if state != self.state:
+            self.plans.clear()
+            self.state = state
+
+        key = get_plan_key(app)
+        if key not in self.plans:
+            task = create_task(self.simulate(app))
+            # Failures aren't kept, so asking again tries again.
+            task.add_done_callback(lambda task: self.plans.pop(key, None) if task.cancelled() or task.exception() else None)
+            self.plans[key] = task
+        return self.plans[key]
+
+    def get_options(self) -> list[str]:
+        return [
+            '-o', f'Dir::Etc::sourceparts={self.sources_dir}',
+            '-o', f'Dir::State::Lists={self.lists_dir}',
+            '-o', f'Dir::Cache={self.cache_dir}',
+            '-o', 'Debug::NoLocking=1',
+        ]
+
+    async def simulate(self, app) -> AptPlan:
+        # Everything needed from the app is taken up front, as it can change while this runs.
+        reinstall_list, install_list = await get_apt_install_lists(app)
+        sources = get_sources(app)
+        changed_sources = get_changed_sources(app)
+        name = app.sources_scanner.enabled_branches_name
+        system_sources_dir = app.sources_scanner.sources_dir
+
+        async with self.lock:
+            await get_running_loop().run_in_executor(None, self.prepare, system_sources_dir, sources, name)
+
+            if changed_sources is None or name in changed_sources:
+                await self.run_apt('apt-get', 'update',
+                                   '-o', f'Dir::Etc::sourcelist={path.join(self.sources_dir, name)}',
+                                   '-o', 'Dir::Etc::sourceparts=-', '-o', 'APT::Get::List-Cleanup=0')
+
+            plan = AptPlan()
+            if reinstall_list:
+                plan.packages.extend(parse_apt_simulation(await self.run_apt('apt-get', '-s', 'install', '--reinstall', '--allow-downgrades', *reinstall_list)))
+            if install_list:
+                plan.packages.extend(parse_apt_simulation(await self.run_apt('apt-get', '-s', 'install', '--allow-downgrades', *install_list)))
+
+            await self.add_sizes(plan)
+        return plan
+
+    async def run_apt(self, command: str, *args: str) -> str:
+        process, output = await run_process([command, *self.get_options(), *args], env=APT_ENV)
+        if process.returncode != 0:
+            tail = '\n'.join(output.strip().splitlines()[-ERROR_TAIL_LINES:])
+            raise Exception(f"Error running {command} {args[0]}: {tail}")
+        return output
+
+    async def add_sizes(self, plan: AptPlan):
+        new_packages = [f'{package.name}={package.new_version}' for package in plan.packages if package.new_version]
+        old_names = [package.name for package in plan.packages if package.old_version]
+
+        new_sizes = parse_package_sizes(await self.run_apt('apt-cache', 'show', *new_packages)) if new_packages else {}
+
+        old_sizes = {}
+        if old_names:
+            _, output = await run_process(['dpkg-query', '-W', '-f', '${binary:Package} ${Version} ${Installed-Size}\n', *old_names], ignore_stderr=True)
+            for line in output.splitlines():
+                name, version, installed_size = (line.split(' ') + ['', ''])[:3]
+                # dpkg qualifies Multi-Arch: same packages with their architecture where apt doesn't, so neither side
+                # keeps it, the same as for the new sizes.
+                old_sizes[(name.split(':')[0], version)] = int(installed_size or 0)
+
+        for package in plan.packages:
+            if package.new_version:
+                size, installed_size = new_sizes.get((package.name.split(':')[0], package.new_version), (0, 0))
+                plan.download_size += size
+                plan.size_change += installed_size * 1024
+            if package.old_version:
+                plan.size_change -= old_sizes.get((package.name.split(':')[0], package.old_version), 0) * 1024
+
+    # Sets up sources as they'd be after applying, and lists starting from the system's. Those are linked rather than
+    # copied, and the ones apt refreshes for us replace their link with a file of our own.
+    def prepare(self, system_sources_dir: str, sources: str, enabled_branches_name: str):
+        for directory in (self.sources_dir, path.join(self.lists_dir, 'partial'), self.cache_dir):
+            makedirs(directory, exist_ok=True)
+
+        for name in listdir(self.sources_dir):
+            unlink(path.join(self.sources_dir, name))
+        for name in listdir(system_sources_dir):
+            if not is_enabled_branches_file(name):
+                symlink(path.join(system_sources_dir, name), path.join(self.sources_dir, name))
+        with open(path.join(self.sources_dir, enabled_branches_name), 'w') as f:
+            f.write(sources + '\n')
+
+        system_lists = {name for name in listdir(self.system_lists_dir) if path.isfile(path.join(self.system_lists_dir, name)) and name != 'lock'}
+        for name in listdir(self.lists_dir):
+            list_path = path.join(self.lists_dir, name)
+            # Whatever the system has refreshed since is at least as new as what we fetched.
+            if path.islink(list_path) or (name in system_lists and path.isfile(list_path)):
+                unlink(list_path)
+        for name in system_lists:
+            if not path.exists(path.join(self.lists_dir, name)):
+                symlink(path.join(self.system_lists_dir, name), path.join(self.lists_dir, name))
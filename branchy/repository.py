@@ -1,21 +1,37 @@
+from bisect import insort
 from dataclasses import dataclass
-from gi.repository import Gtk
+from typing import Dict
 
 
-@dataclass
+# Branches are plain data, so the model can be built, cached and compared without GTK. The widgets showing them are
+# tracked by the UI, keyed by repository and branch name.
+@dataclass(frozen=True, slots=True)
 class Branch:
     name: str
     timestamp: int
-    packages: list[str]
+    packages: tuple[str, ...]
     version: str
-    radio: Gtk.CheckButton = None
 
 
 class Repository:
     def __init__(self, name: str):
         self.name = name
         self.branches: list[Branch] = []
+        self.branches_by_name: Dict[str, Branch] = {}
+        self.newest_timestamp = 0
 
     def add_branch(self, branch: Branch):
-        self.branches.append(branch)
+        # Branches are kept newest first. A branch with the same timestamp as others goes after them.
+        insort(self.branches, branch, key=lambda x: -x.timestamp)
+        self.newest_timestamp = max(self.newest_timestamp, branch.timestamp)
+
+        # If a name shows up more than once, lookups find the one that comes first, like a scan of the list would.
+        existing = self.branches_by_name.get(branch.name)
+        if existing is None or existing.timestamp < branch.timestamp:
+            self.branches_by_name[branch.name] = branch
+
+    def add_branches(self, branches: list[Branch]):
+        self.branches.extend(branches)
         self.branches.sort(key=lambda x: x.timestamp, reverse=True)
+        self.newest_timestamp = self.branches[0].timestamp if self.branches else 0
+        self.branches_by_name = {branch.name: branch for branch in reversed(self.branches)}
@@ -0,0 +1,58 @@
+from asyncio import Task, create_task, wait
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+
+@dataclass
+class FlightStats:
+    requested: int = 0
+    runs: int = 0
+    coalesced: int = 0
+
+    def __str__(self):
+        return f"{self.requested} requested, {self.runs} run, {self.coalesced} coalesced"
+
+
+# Runs an async function so that there's only ever one run of it in flight. Whatever is asked for while it's running
+# can't be sure that run saw its changes, so all of it is collapsed into a single follow-up run once it's done.
+# Everybody gets a task to await, shared with whoever else ended up on the same run.
+class SingleFlight:
+    def __init__(self, function: Callable[[], Awaitable]):
+        self.function = function
+        self.running: Optional[Task] = None
+        self.follow_up: Optional[Task] = None
+        self.stats = FlightStats()
+
+    def __call__(self) -> Task:
+        self.stats.requested += 1
+
+        if self.running is None:
+            self.running = self.start()
+            return self.running
+
+        if self.follow_up is None:
+            self.follow_up = self.start(after=self.running)
+        else:
+            self.stats.coalesced += 1
+        return self.follow_up
+
+    def start(self, after: Optional[Task] = None) -> Task:
+        task = create_task(self.run(after))
+        # A done callback rather than a finally, which a task cancelled before it started would never get to.
+        task.add_done_callback(self.on_done)
+        return task
+
+    async def run(self, after: Optional[Task]):
+        if after is not None:
+            await wait([after])
+            self.running, self.follow_up = self.follow_up, None
+
+        self.stats.runs += 1
+        return await self.function()
+
+    def on_done(self, task: Task):
+        if self.follow_up is task:
+            self.follow_up = None
+        # A queued follow-up takes over from the run before it, so new requests keep joining it until it starts.
+        if self.follow_up is None and self.running is not None and self.running.done():
+            self.running = None
@@ -0,0 +1,75 @@
+from typing import Dict, Optional, Set, Tuple, Union
+
+# Below this length a fuzzy match would hit almost everything, so short queries only match substrings.
+FUZZY_MIN_LENGTH = 3
+
+SearchKey = Union[str, Tuple[str, str]]
+
+
+def is_subsequence(query: str, term: str) -> bool:
+    position = 0
+    for char in query:
+        position = term.find(char, position) + 1
+        if not position:
+            return False
+    return True
+
+
+# Whether everything matching `new` is guaranteed to also match `old`, e.g. because the user typed one more character.
+def is_refinement(old: str, new: str) -> bool:
+    return new.startswith(old) and (len(old) >= FUZZY_MIN_LENGTH) == (len(new) >= FUZZY_MIN_LENGTH)
+
+
+def matches(query: str, term: str, fuzzy: bool) -> bool:
+    # Substring matching covers prefixes too.
+    return query in term or (fuzzy and is_subsequence(query, term))
+
+
+class SearchIndex:
+    def __init__(self, repositories):
+        self.repos: Dict[str, str] = {}
+        self.branches: Dict[Tuple[str, str], Tuple[str, ...]] = {}
+        self.branches_by_repo: Dict[str, list[Tuple[str, str]]] = {}
+
+        for repo, repository in repositories.items():
+            self.repos[repo] = repo.lower()
+            self.branches_by_repo[repo] = []
+            for branch in repository.branches:
+                key = (repo, branch.name)
+                self.branches[key] = (branch.name.lower(), *(package.lower() for package in branch.packages))
+                self.branches_by_repo[repo].append(key)
+
+        self.last_query = ''
+        self.last_repo_matches: Set[str] = set()
+        self.last_branch_matches: Set[Tuple[str, str]] = set()
+
+    # Returns the repo names and (repo, branch) pairs that should be visible for the query, or None if everything should
+    # be. A repo that matches shows all of its branches, and a branch matches by its name or any of its package names.
+    def search(self, query: str) -> Optional[Set[SearchKey]]:
+        query = query.strip().lower()
+        if not query:
+            self.last_query = ''
+            return None
+
+        fuzzy = len(query) >= FUZZY_MIN_LENGTH
+
+        # Typing one more character can only narrow the results down, so we only need to look at what matched before.
+        if self.last_query and is_refinement(self.last_query, query):
+            repo_candidates, branch_candidates = self.last_repo_matches, self.last_branch_matches
+        else:
+            repo_candidates, branch_candidates = self.repos.keys(), self.branches.keys()
+
+        repo_matches = {repo for repo in repo_candidates if matches(query, self.repos[repo], fuzzy)}
+        branch_matches = {key for key in branch_candidates if any(matches(query, term, fuzzy) for term in self.branches[key])}
+
+        self.last_query = query
+        self.last_repo_matches, self.last_branch_matches = repo_matches, branch_matches
+
+        visible: Set[SearchKey] = set(repo_matches)
+        for repo in repo_matches:
+            visible.update(self.branches_by_repo[repo])
+        for key in branch_matches:
+            visible.add(key)
+            visible.add(key[0])
+
+        return visible
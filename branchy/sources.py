@@ -0,0 +1,160 @@
+from datetime import datetime
+from os import environ, listdir, path
+from threading import Lock
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+from .metrics import metrics
+from .packages import get_file_stamp
+from .utils import SOURCES_DIR, ENABLED_BRANCHES_NAME, ENABLED_BRANCHES_DEB822_NAME, CODENAME, DEB_URL_TEMPLATE, DEB_URL_RE
+
+# Which format we write our sources in: 'list' for one-line entries, 'deb822' for stanzas. By default it's whatever the
+# system's own sources use.
+SOURCES_FORMAT = environ.get('BRANCHY_SOURCES_FORMAT')
+
+
+def is_sources_file(filename: str) -> bool:
+    return filename.endswith(('.list', '.sources'))
+
+
+def is_enabled_branches_file(filename: str) -> bool:
+    return filename in (ENABLED_BRANCHES_NAME, ENABLED_BRANCHES_DEB822_NAME)
+
+
+def get_branch(uri: str) -> Optional[Tuple[str, str]]:
+    match = DEB_URL_RE.fullmatch(uri)
+    return (match.group(1), match.group(2)) if match else None
+
+
+def read_sources_file(file_path: str) -> Dict[str, str]:
+    with open(file_path, 'r') as f:
+        uris = iter_deb822_uris(f) if file_path.endswith('.sources') else iter_one_line_uris(f)
+        return dict(branch for branch in map(get_branch, uris) if branch is not None)
+
+
+# deb [ option=value ... ] uri suite [component ...]
+def iter_one_line_uris(f) -> Iterator[str]:
+    for line in f:
+        line = line.split('#', 1)[0]
+        if not line.startswith('deb '):
+            continue
+
+        rest = line[4:].strip()
+        if rest.startswith('['):
+            rest = rest.partition(']')[2].strip()
+        if rest:
+            yield rest.split(None, 1)[0]
+
+
+def iter_deb822_uris(f) -> Iterator[str]:
+    for fields in iter_deb822_stanzas(f):
+        if 'deb' in fields.get('types', '').split() and fields.get('enabled', 'yes').lower() != 'no':
+            yield from fields.get('uris', '').split()
+
+
+# Field names are case-insensitive, and a field goes on over any lines that start with whitespace, like the keys that
+# Signed-By can have inline.
+def iter_deb822_stanzas(f) -> Iterator[Dict[str, str]]:
+    fields = {}
+    name = None
+    for line in f:
+        if line.startswith('#'):
+            continue
+
+        if not line.strip():
+            if fields:
+                yield fields
+            fields, name = {}, None
+        elif line[0] in ' \t':
+            if name is not None:
+                fields[name] += ' ' + line.strip()
+        else:
+            key, separator, value = line.partition(':')
+            if separator:
+                name = key.strip().lower()
+                fields[name] = value.strip()
+
+    if fields:
+        yield fields
+
+
+# Files are gone through in the order apt reads them, so if a repository is in more than one, the last one wins.
+def merge_sources(sources: Dict[str, Dict[str, str]]) -> tuple[Dict[str, str], Dict[str, Tuple[str, str]]]:
+    enabled_branches = {}
+    system_branches = {}
+    for filename in sorted(sources):
+        for repo, branch in sources[filename].items():
+            if is_enabled_branches_file(filename):
+                enabled_branches[repo] = branch
+            else:
+                system_branches[repo] = (branch, filename)
+    return enabled_branches, system_branches
+
+
+def format_sources(branches: Dict[str, str], sources_format: str) -> str:
+    content = [f"# This file was generated by Branchy on {datetime.now().isoformat()}\n"]
+    for repo, branch in branches.items():
+        uri = DEB_URL_TEMPLATE.format(repo=repo, codename=CODENAME, branch=branch)
+        if sources_format == 'deb822':
+            content.append(f"Types: deb\nURIs: {uri}\nSuites: {CODENAME}\nComponents: main\n")
+        else:
+            content.append(f"deb {uri} {CODENAME} main")
+    return '\n'.join(content)
+
+
+# Reads the branches in the sources, keeping what it found in each file for as long as the file looks the same. The
+# reading is all blocking, so it's meant to be run in an executor. Scans can be started from more than one thread, so
+# files is only ever replaced by a finished scan, never changed in place, and can be read from anywhere.
+class SourcesScanner:
+    def __init__(self, sources_dir: str = SOURCES_DIR):
+        self.sources_dir = sources_dir
+        self.files: Dict[str, Tuple[Tuple[int, int, int], Dict[str, str]]] = {}
+        self.forgotten: Set[str] = set()
+        # One scan at a time, so one doesn't put back what another has found out of date.
+        self.lock = Lock()
+
+    @property
+    def format(self) -> str:
+        if SOURCES_FORMAT:
+            return SOURCES_FORMAT
+        deb822 = any(name.endswith('.sources') and not is_enabled_branches_file(name) for name in self.files)
+        return 'deb822' if deb822 else 'list'
+
+    @property
+    def enabled_branches_name(self) -> str:
+        return ENABLED_BRANCHES_DEB822_NAME if self.format == 'deb822' else ENABLED_BRANCHES_NAME
+
+    # For when a file is known to have changed, even if it doesn't look like it. The next scan reads it again, and this
+    # doesn't wait for one that's running.
+    def forget(self, filename: str):
+        self.forgotten.add(filename)
+
+    def scan(self) -> Dict[str, Dict[str, str]]:
+        with self.lock:
+            sources = {}
+            files = {}
+            for filename in listdir(self.sources_dir):
+                if not is_sources_file(filename):
+                    continue
+
+                file_path = path.join(self.sources_dir, filename)
+                stamp = get_file_stamp(file_path)
+                cached = self.files.get(filename)
+                if filename in self.forgotten:
+                    self.forgotten.discard(filename)
+                elif cached is not None and cached[0] == stamp:
+                    sources[filename] = cached[1]
+                    files[filename] = cached
+                    continue
+
+                try:
+                    sources[filename] = read_sources_file(file_path)
+                    files[filename] = (stamp, sources[filename])
+                except (IOError, UnicodeError) as e:
+                    print(f"Error reading {filename}: {e}")
+
+            self.files = files
+            return sources
+
+    def get_branches(self) -> tuple[Dict[str, str], Dict[str, Tuple[str, str]]]:
+        with metrics.span('get_enabled_branches'):
+            return merge_sources(self.scan())
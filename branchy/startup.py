@@ -0,0 +1,60 @@
+from contextlib import contextmanager
+from os import sysconf
+from time import clock_gettime, perf_counter, CLOCK_BOOTTIME
+from typing import Optional, Tuple
+
+
+# How long this process had been running before we got to run anything, i.e. interpreter startup. Only as precise as
+# the kernel's clock ticks, usually 10ms.
+def get_process_age() -> float:
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        return max(clock_gettime(CLOCK_BOOTTIME) - start_ticks / sysconf('SC_CLK_TCK'), 0.0)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+# Times the phases of startup, in seconds since the process started. Recording is cheap enough to always be on, and
+# stops once finished, so only the first window, refresh etc. are counted.
+class StartupProfile:
+    def __init__(self):
+        self.start = perf_counter() - get_process_age()
+        self.phases: list[Tuple[str, float, Optional[float]]] = [('interpreter', 0.0, perf_counter() - self.start)]
+        self.finished = False
+
+    @contextmanager
+    def phase(self, name: str):
+        if self.finished:
+            yield
+            return
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            if not self.finished:
+                self.phases.append((name, start - self.start, perf_counter() - start))
+
+    def mark(self, name: str):
+        if not self.finished:
+            self.phases.append((name, perf_counter() - self.start, None))
+
+    def finish(self) -> str:
+        self.finished = True
+
+        # Phases are recorded as they end, so nested ones come before the phase around them.
+        phases = sorted(self.phases, key=lambda phase: (phase[1], -(phase[2] or 0)))
+        lines = ['   start   duration']
+        open_phases = []
+        for name, offset, duration in phases:
+            open_phases = [end for end in open_phases if end > offset]
+            duration_text = f'{duration * 1000:8.1f}ms' if duration is not None else ' ' * 10
+            lines.append(f'{offset * 1000:6.1f}ms {duration_text}  {"  " * len(open_phases)}{name}')
+            if duration is not None:
+                open_phases.append(offset + duration)
+
+        return '\n'.join(lines)
+
+
+startup_profile = StartupProfile()
@@ -0,0 +1,116 @@
+from asyncio import gather
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from .cache import ResponseCache
+from .http import HttpClient
+from .packages import PackageState
+from .repository import Repository
+from .search import SearchIndex
+from .sources import SourcesScanner
+from .sys import refresh_branches, get_removed_branches
+
+
+# Everything the functions in sys.py expect to find on the app, without the app. This is what Branchy runs on when
+# there's no GTK around, e.g. from the command line.
+class BranchState:
+    def __init__(self):
+        self.repositories: Dict[str, Repository] = OrderedDict()
+        self.changed_branches: Dict[str, Tuple[str, str]] = {}
+        self.enabled_branches: Dict[str, str] = {}
+        self.initial_branches: Dict[str, str] = {}
+        self.system_branches: Dict[str, Tuple[str, str]] = {}
+        self.installed_versions: Dict[str, str] = {}
+        self.package_state = PackageState()
+        self.branch_list_cache = ResponseCache('branches')
+        self.http = HttpClient()
+        self.sources_scanner = SourcesScanner()
+        self.parsed_validator = None
+        self.search_index = SearchIndex(self.repositories)
+
+    async def close(self):
+        await self.http.close()
+
+    def clear(self):
+        self.enabled_branches.clear()
+        self.system_branches.clear()
+        self.changed_branches.clear()
+        self.initial_branches.clear()
+
+    async def load(self, cached: bool = False):
+        self.clear()
+        self.installed_versions, _ = await gather(self.package_state.get_installed_versions(), self.load_branches(cached))
+        self.changed_branches = get_removed_branches(self)
+
+    async def load_branches(self, cached: bool):
+        # With cached, the network is only used if there's nothing cached yet.
+        if not cached or not await refresh_branches(self, from_cache=True):
+            await refresh_branches(self)
+
+    def get_branch(self, repo: str, branch: str):
+        if repo not in self.repositories:
+            raise ValueError(f"Unknown repository: {repo}")
+        if branch not in self.repositories[repo].branches_by_name:
+            raise ValueError(f"Unknown branch for {repo}: {branch}")
+        return self.repositories[repo].branches_by_name[branch]
+
+    # Whether the branch we're on has a newer version than what's installed, like the warning next to it in the UI.
+    def needs_update(self, repo: str) -> bool:
+        branch = self.initial_branches.get(repo)
+        if branch is None or repo not in self.repositories or branch not in self.repositories[repo].branches_by_name:
+            return False
+
+        installed_version = self.installed_versions.get(repo)
+        version = self.repositories[repo].branches_by_name[branch].version
+        return bool(version and installed_version and version != installed_version)
+
+    # These follow the same rules as toggling the radio buttons in BranchyApp.on_branch_toggled.
+    def enable(self, repo: str, branch: str):
+        self.get_branch(repo, branch)
+
+        initial_branch = self.initial_branches.get(repo)
+        system_branch = self.system_branches.get(repo, (None, None))[0]
+
+        if branch == initial_branch:
+            # Enabling the branch we're already on only means something if there's an update for it.
+            self.enabled_branches[repo] = branch
+            if self.needs_update(repo):
+                self.changed_branches[repo] = (branch, branch)
+            else:
+                self.changed_branches.pop(repo, None)
+        elif branch == system_branch:
+            # The system branch is already there without us, so this is the same as disabling ours.
+            self.disable(repo)
+        else:
+            self.enabled_branches[repo] = branch
+            self.changed_branches[repo] = (initial_branch, branch)
+
+    def disable(self, repo: str):
+        if repo not in self.repositories:
+            raise ValueError(f"Unknown repository: {repo}")
+
+        self.enabled_branches.pop(repo, None)
+
+        initial_branch = self.initial_branches.get(repo)
+        if initial_branch is not None:
+            self.changed_branches[repo] = (initial_branch, None)
+        else:
+            self.changed_branches.pop(repo, None)
+
+    def get_status(self) -> Dict[str, Dict[str, Optional[str]]]:
+        status = {}
+        for repo in sorted(set(self.enabled_branches) | set(self.system_branches) | set(self.changed_branches)):
+            system_branch, system_file = self.system_branches.get(repo, (None, None))
+            enabled_branch = self.enabled_branches.get(repo)
+            branch = enabled_branch or system_branch
+            available = self.repositories[repo].branches_by_name.get(branch) if repo in self.repositories else None
+
+            status[repo] = {
+                'branch': branch,
+                'source': system_file if branch == system_branch and system_branch else None,
+                'installed_version': self.installed_versions.get(repo),
+                'available_version': available.version if available else None,
+                'update_needed': self.needs_update(repo),
+                'change': list(self.changed_branches[repo]) if repo in self.changed_branches else None,
+            }
+        return status
@@ -1,113 +1,250 @@
-from asyncio import create_subprocess_exec, subprocess
-from aiohttp import ClientSession as HttpClientSession
-from os import listdir, path, unlink, environ
-from re import search
-from typing import Dict
-from collections import OrderedDict
-from datetime import datetime
-
+from asyncio import create_subprocess_exec, gather, get_running_loop, subprocess
+from os import path, unlink, environ, geteuid
+from typing import Dict, Iterable, Optional, Tuple
+from collections import OrderedDict, deque
+from shlex import quote
+
+from .cache import ResponseCache, CacheEntry
+from .http import HttpClient, HttpStatusError
+from .metrics import metrics
+from .parser import BranchRecord, BranchRecordParser, parse_branch_chunks
 from .repository import Repository, Branch
-from .utils import validate_branch_data, SOURCES_DIR, BRANCH_LIST_URL, ENABLED_BRANCHES_NAME, CODENAME, DEB_URL_TEMPLATE
+from .search import SearchIndex
+from .sources import SourcesScanner, format_sources
+from .utils import SOURCES_DIR, BRANCH_LIST_URL, ENABLED_BRANCHES_NAME, ENABLED_BRANCHES_DEB822_NAME
+
+# apt can print very long lines while drawing its progress bars.
+PROCESS_LINE_LIMIT = 1024 * 1024
+# How much of a failed process's output ends up in the error message.
+ERROR_TAIL_LINES = 100
+
+
+async def refresh_branches(app, from_cache: bool = False, only_if_changed: bool = False) -> bool:
+    if from_cache:
+        entry = app.branch_list_cache.load()
+        if entry is None:
+            return False
+        load_records = read_cached_branch_records(app.branch_list_cache, entry, app.parsed_validator)
+    else:
+        load_records = fetch_branch_records(app.http, app.branch_list_cache, parsed_validator=app.parsed_validator)
+
+    # The branch list and the sources don't depend on each other, so they're read at the same time. Nothing is
+    # changed on the app until both are in, so a refresh that's cancelled halfway leaves it as it was.
+    try:
+        (entry, records), (enabled_branches, system_branches) = await gather(
+            load_records,
+            get_running_loop().run_in_executor(None, app.sources_scanner.get_branches),
+        )
+    except ValueError as e:
+        if not from_cache:
+            raise
+        # The cached copy didn't parse and has been cleared, so it's as if nothing was cached and the caller goes to
+        # the network instead.
+        print(f"Error reading cached branch list: {e}")
+        return False
 
+    if records is not None:
+        app.repositories.clear()
+        parse_branches(app, records)
+        app.parsed_validator = entry.validator
+    elif only_if_changed:
+        return False
 
-async def refresh_branches(app):
-    app.clear()
+    load_enabled_branches(app, enabled_branches, system_branches)
 
-    async with HttpClientSession() as session:
-        async with session.get(BRANCH_LIST_URL) as response:
-            if response.status == 200:
-                data = await response.text()
-                parse_branches(app, data)
-            else:
-                raise Exception(f"Failed to fetch branches: HTTP {response.status}")
+    return records is not None
+
+
+async def read_cached_branch_records(cache: ResponseCache, entry: CacheEntry, parsed_validator: str = None) -> tuple[CacheEntry, Optional[list[BranchRecord]]]:
+    return entry, await get_running_loop().run_in_executor(None, read_cached_records, cache, entry, parsed_validator)
+
+
+# Both of these return None instead of the records if the branch list is the one we last parsed, going by its validator.
+def read_cached_records(cache: ResponseCache, entry: CacheEntry, parsed_validator: str = None) -> Optional[list[BranchRecord]]:
+    if entry.validator is not None and entry.validator == parsed_validator:
+        return None
 
-    app.enabled_branches = get_enabled_branches(app)
+    try:
+        with metrics.span('read_cached_branch_list'):
+            return list(parse_branch_chunks(cache.read_chunks()))
+    except ValueError:
+        # Otherwise the server would keep telling us to use this copy.
+        cache.clear()
+        raise
+
+
+async def fetch_branch_records(http: HttpClient, cache: ResponseCache, url: str = BRANCH_LIST_URL, parsed_validator: str = None) -> tuple[CacheEntry, Optional[list[BranchRecord]]]:
+    # Retrying covers the body too, so a connection that drops halfway through starts over with a fresh parser.
+    return await http.retry(lambda: fetch_branch_records_once(http, cache, url, parsed_validator))
+
+
+async def fetch_branch_records_once(http: HttpClient, cache: ResponseCache, url: str, parsed_validator: str = None) -> tuple[CacheEntry, Optional[list[BranchRecord]]]:
+    cached = cache.load()
+    headers = cached.conditional_headers() if cached else {}
+
+    with metrics.span('fetch_branch_list', url=url):
+        async with http.get(url, headers=headers) as response:
+            if response.status == 304 and cached:
+                # Parsing the cached copy is as slow as parsing a download, so it's kept off the loop the same way.
+                return await read_cached_branch_records(cache, cached, parsed_validator)
+            elif response.status != 200:
+                raise HttpStatusError(url, response.status)
+
+            entry = CacheEntry(response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            if entry.validator is not None and entry.validator == parsed_validator:
+                return entry, None
+
+            # Records are parsed as the chunks come in, and the body goes straight to the cache without being kept.
+            parser = BranchRecordParser()
+            records = []
+            with cache.writer(entry) as writer:
+                async for chunk in response.content.iter_any():
+                    metrics.count('bytes_downloaded', len(chunk))
+                    writer.write(chunk)
+                    records.extend(parser.feed(chunk))
+                records.extend(parser.close())
+
+            return entry, records
+
+
+# If branches got removed from the server, enabled_branches won't match initial_branches. These have to be disabled.
+def get_removed_branches(app) -> Dict[str, tuple[str, None]]:
+    removed_branches = {}
+    for repo, branch in app.initial_branches.items():
+        if repo not in app.enabled_branches or branch not in app.enabled_branches[repo]:
+            removed_branches[repo] = (branch, None)
+    return removed_branches
+
+
+def load_enabled_branches(app, enabled_branches: Dict[str, str], system_branches: Dict[str, Tuple[str, str]]):
+    app.enabled_branches = enabled_branches
+    app.system_branches = system_branches
     app.initial_branches = app.enabled_branches.copy()
 
     # If there are branches that we had enabled that no longer exist, disable them
     new_enabled_branches = app.enabled_branches.copy()
     for repo, branch in app.enabled_branches.items():
-        if repo not in app.repositories or branch not in (x.name for x in app.repositories[repo].branches):
+        if repo not in app.repositories or branch not in app.repositories[repo].branches_by_name:
             new_enabled_branches.pop(repo)
 
     app.enabled_branches = new_enabled_branches
 
 
-def parse_branches(app, data: str):
-    lines = data.strip().split('\n')
-    for i in range(0, len(lines), 5):
-        repo_name = lines[i]
-        branch_name = lines[i + 1].strip()
-        timestamp = int(lines[i + 2].strip())
-        packages = lines[i + 3].strip().split(' ')
-        version = lines[i + 4].strip()
-
-        validate_branch_data(repo_name, branch_name, packages, version)
-
-        if repo_name not in app.repositories:
-            app.repositories[repo_name] = Repository(repo_name)
-        
-        branch = Branch(branch_name, timestamp, packages, version)
-        app.repositories[repo_name].add_branch(branch)
-
-    app.repositories = OrderedDict(sorted(
-        app.repositories.items(),
-        key=lambda x: max(branch.timestamp for branch in x[1].branches),
-        reverse=True
-    ))
-
-
-def get_enabled_branches(app) -> Dict[str, str]:
-    enabled_branches = {}
-    app.system_branches = {}
-    for filename in listdir(SOURCES_DIR):
-        if filename.endswith('.list'):
-            try:
-                with open(path.join(SOURCES_DIR, filename), 'r') as f:
-                    for line in f:
-                        if line.startswith('deb '):
-                            match = search(DEB_URL_TEMPLATE.format(repo='(.+)', codename=CODENAME, branch='(.+)'), line)
-                            if match:
-                                repo = match.group(1)
-                                branch = match.group(2)
-                                if filename == ENABLED_BRANCHES_NAME:
-                                    enabled_branches[repo] = branch
-                                else:
-                                    app.system_branches[repo] = (branch, filename)
-            except IOError as e:
-                print(f"Error reading {filename}: {e}")
-    return enabled_branches
-
-
-async def run_process(args: list[str], output_stream_callback: callable = None, ignore_stderr: bool = False) -> tuple[subprocess.Process, str]:
-    process = await create_subprocess_exec(
-        *args,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT if not ignore_stderr else subprocess.DEVNULL
-    )
-
-    output = []
-
-    while True:
-        line = await process.stdout.readline()
-        if not line:
-            break
-
-        output += line.decode('utf-8')
-
-        if output_stream_callback:
-            output_stream_callback(line)
-
-    await process.communicate()
-
-    return process, ''.join(output)
-
-
-async def apply_changes(app, output_stream_callback: callable = None):
+# Brings the branches in the sources up to date without a refresh, and returns the repositories that changed. Whatever
+# the user has changed in other repositories is kept.
+def patch_enabled_branches(app, enabled_branches: Dict[str, str], system_branches: Dict[str, Tuple[str, str]]) -> set[str]:
+    repos = {repo for repo in enabled_branches.keys() | app.initial_branches.keys()
+             if enabled_branches.get(repo) != app.initial_branches.get(repo)}
+    repos |= {repo for repo in system_branches.keys() | app.system_branches.keys()
+              if system_branches.get(repo) != app.system_branches.get(repo)}
+
+    for repo in repos:
+        for branches, new_branches in ((app.initial_branches, enabled_branches), (app.system_branches, system_branches)):
+            if repo in new_branches:
+                branches[repo] = new_branches[repo]
+            else:
+                branches.pop(repo, None)
+
+        # Same as load_enabled_branches, a branch that no longer exists isn't enabled.
+        branch = enabled_branches.get(repo)
+        if branch is not None and repo in app.repositories and branch in app.repositories[repo].branches_by_name:
+            app.enabled_branches[repo] = branch
+        else:
+            app.enabled_branches.pop(repo, None)
+
+    return repos
+
+
+def parse_branches(app, records: Iterable[BranchRecord]):
+    with metrics.span('parse_branches'):
+        branches: Dict[str, list[Branch]] = {}
+        for repo_name, branch in records:
+            branches.setdefault(repo_name, []).append(branch)
+
+        # Everything is added in one go, so each repository only sorts its branches once.
+        for repo_name, repo_branches in branches.items():
+            if repo_name not in app.repositories:
+                app.repositories[repo_name] = Repository(repo_name)
+            app.repositories[repo_name].add_branches(repo_branches)
+
+        app.repositories = OrderedDict(sorted(
+            app.repositories.items(),
+            key=lambda x: x[1].newest_timestamp,
+            reverse=True
+        ))
+
+        app.search_index = SearchIndex(app.repositories)
+
+
+# Returns our enabled branches, and the system branches along with the file they're from. This only reads files, so
+# it can run off the main thread.
+def get_enabled_branches(sources_dir: str = SOURCES_DIR) -> tuple[Dict[str, str], Dict[str, Tuple[str, str]]]:
+    return SourcesScanner(sources_dir).get_branches()
+
+
+class ProcessStream:
+    def __init__(self, args: list[str], ignore_stderr: bool = False, env: Dict[str, str] = None):
+        self.args = args
+        self.ignore_stderr = ignore_stderr
+        self.env = env
+        self.process: subprocess.Process = None
+
+    @property
+    def returncode(self) -> int:
+        return self.process.returncode if self.process else None
+
+    def __aiter__(self):
+        return self.lines()
+
+    async def lines(self):
+        self.process = await create_subprocess_exec(
+            *self.args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if not self.ignore_stderr else subprocess.DEVNULL,
+            limit=PROCESS_LINE_LIMIT,
+            env=self.env
+        )
+        metrics.count('subprocesses_spawned')
+
+        try:
+            while True:
+                line = await self.process.stdout.readline()
+                if not line:
+                    break
+                yield line
+
+            await self.process.wait()
+        finally:
+            # If the consumer stopped early, don't leave the process behind.
+            if self.process.returncode is None:
+                self.process.kill()
+                await self.process.wait()
+
+
+def stream_process(args: list[str], ignore_stderr: bool = False, env: Dict[str, str] = None) -> ProcessStream:
+    return ProcessStream(args, ignore_stderr, env)
+
+
+async def run_process(args: list[str], output_stream_callback: callable = None, ignore_stderr: bool = False, tail_lines: int = None, env: Dict[str, str] = None) -> tuple[subprocess.Process, str]:
+    # With tail_lines, only the last lines are kept around, which is all an error message needs.
+    output = [] if tail_lines is None else deque(maxlen=tail_lines)
+
+    with metrics.span('run_process', command=' '.join(args[:3])):
+        stream = stream_process(args, ignore_stderr, env)
+        async for line in stream:
+            output.append(line)
+
+            if output_stream_callback:
+                output_stream_callback(line)
+
+        return stream.process, b''.join(output).decode('utf-8', errors='replace')
+
+
+async def apply_changes(app, output_stream_callback: callable = None, also_install: bool = True):
     if not app.changed_branches:
         return
 
-    script_content = await generate_update_script(app)
+    script_content = await generate_update_script(app, also_install)
 
     if output_stream_callback:
         output_stream_callback(script_content.encode('utf-8'))
@@ -119,8 +256,9 @@ async def apply_changes(app, output_stream_callback: callable = None):
 
     try:
         process, output = await run_process(
-            ['pkexec', 'bash', temp_path],
-            output_stream_callback=output_stream_callback
+            ['bash', temp_path] if geteuid() == 0 else ['pkexec', 'bash', temp_path],
+            output_stream_callback=output_stream_callback,
+            tail_lines=ERROR_TAIL_LINES
         )
 
         if process.returncode != 0:
@@ -130,43 +268,87 @@ async def apply_changes(app, output_stream_callback: callable = None):
         unlink(temp_path)
 
 
-async def generate_update_script(app) -> str:
-    return f"""#!/bin/bash
+async def generate_update_script(app, also_install: bool = True) -> str:
+    # Our sources are written in the same format as the system's, and whatever we wrote in the other one goes.
+    name = app.sources_scanner.enabled_branches_name
+    other_name = ENABLED_BRANCHES_DEB822_NAME if name == ENABLED_BRANCHES_NAME else ENABLED_BRANCHES_NAME
+
+    with metrics.span('generate_update_script'):
+        return f"""#!/bin/bash
 set -e
 
-cat << EOF > {SOURCES_DIR}/{ENABLED_BRANCHES_NAME}
+cat << EOF > {SOURCES_DIR}/{name}
 {get_sources(app)}
 EOF
+rm -f {SOURCES_DIR}/{other_name}
 
-apt update -y
+{generate_apt_update_command(app)}
 
-{await generate_apt_install_commands(app)}
+{await generate_apt_install_commands(app) if also_install else ''}
 """
 
 
 def get_sources(app) -> str:
-    content = [f"# This file was generated by Branchy on {datetime.now().isoformat()}\n"]
-    for repo, branch in app.enabled_branches.items():
-        if app.system_branches.get(repo) and branch == app.system_branches[repo][0]:
-            continue
-        content.append(f"deb {DEB_URL_TEMPLATE.format(repo=repo, codename=CODENAME, branch=branch)} {CODENAME} main")
-    return '\n'.join(content)
-
-
-async def generate_apt_install_commands(app) -> str:
+    branches = {repo: branch for repo, branch in app.enabled_branches.items()
+                if not (app.system_branches.get(repo) and branch == app.system_branches[repo][0])}
+    return format_sources(branches, app.sources_scanner.format)
+
+
+# The sources apt has to refresh for the changes to take effect, or None if it takes a full update. A branch that's
+# dropped falls back to whichever source has the package, and that's only known when it's a system branch.
+def get_changed_sources(app) -> Optional[list[str]]:
+    name = app.sources_scanner.enabled_branches_name
+    sources = []
+    for repo, (_, new_branch) in app.changed_branches.items():
+        if new_branch is not None:
+            source = name
+        elif repo in app.system_branches:
+            source = app.system_branches[repo][1]
+        else:
+            return None
+
+        if source not in sources:
+            sources.append(source)
+
+    return sorted(sources, key=lambda source: source != name)
+
+
+def generate_apt_update_command(app) -> str:
+    sources = get_changed_sources(app)
+    if sources is None:
+        return 'apt update -y'
+
+    # Without List-Cleanup=0, apt would delete the lists of every source that isn't part of the update. If refreshing
+    # just these fails for whatever reason, everything gets refreshed instead.
+    updates = [
+        f"apt-get update -o {quote(f'Dir::Etc::sourcelist={path.join(SOURCES_DIR, source)}')} -o Dir::Etc::sourceparts=- -o APT::Get::List-Cleanup=0"
+        for source in sources
+    ]
+    return f"{' && '.join(updates)} || apt update -y"
+
+
+# Packages to reinstall because their branch is going away, and package=version to install from new branches. Only
+# what the user has installed is touched.
+async def get_apt_install_lists(app) -> tuple[list[str], list[str]]:
     reinstall_list = []
     install_list = []
     for repo, (old_branch, new_branch) in app.changed_branches.items():
-        branch_info = next((x for x in app.repositories[repo].branches if x.name == (new_branch or old_branch)), None)
+        branch_info = app.repositories[repo].branches_by_name.get(new_branch or old_branch)
 
         if branch_info:
-            user_installed_packages_subset = list((await get_installed_package_versions(branch_info.packages)).keys())
+            user_installed_packages_subset = list((await app.package_state.get_installed_subset(branch_info.packages)).keys())
 
             if new_branch is None:
                 reinstall_list.extend(user_installed_packages_subset)
             else:
                 install_list.extend(f"{pkg}={branch_info.version}" for pkg in user_installed_packages_subset)
 
+    return reinstall_list, install_list
+
+
+async def generate_apt_install_commands(app) -> str:
+    reinstall_list, install_list = await get_apt_install_lists(app)
+
     commands = []
     if reinstall_list:
         commands.append(f"apt install --reinstall --allow-downgrades -y {' '.join(reinstall_list)}")
@@ -176,16 +358,18 @@ async def generate_apt_install_commands(app) -> str:
     return ' && '.join(commands) if commands else ''
 
 
-async def get_installed_package_versions(filter: list[str] = []) -> Dict[str, str]:
-    process, output = await run_process(['dpkg-query', '-f', '${binary:Package} ${Version}\n', '-W', *filter], ignore_stderr=True)
+async def get_installed_package_versions(filter: list[str] = [], admindir: str = None) -> Dict[str, str]:
+    with metrics.span('get_installed_package_versions'):
+        admindir_args = [f'--admindir={admindir}'] if admindir else []
+        process, output = await run_process(['dpkg-query', *admindir_args, '-f', '${binary:Package} ${Version}\n', '-W', *filter], ignore_stderr=True)
 
-    versions = {}
-    for line in output.strip().split('\n'):
-        parts = line.split(' ')
-        if len(parts) < 2:
-            continue
+        versions = {}
+        for line in output.strip().split('\n'):
+            parts = line.split(' ')
+            if len(parts) < 2:
+                continue
 
-        package, version = line.split(' ', 1)
-        versions[package] = version
+            package, version = line.split(' ', 1)
+            versions[package] = version
 
-    return versions
+        return versions
@@ -1,7 +1,50 @@
-from asyncio import create_task
-from gi.repository import Gtk, Adw
+from collections import OrderedDict
+from dataclasses import dataclass
+from os import makedirs, path
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from gi.repository import GLib, Gtk, Adw
+from .cache import CACHE_DIR
+from .metrics import metrics
 from .utils import get_time_ago
 
+# How long the search entry waits after the last keystroke before searching.
+SEARCH_DELAY_MS = 100
+# How many lines of output the progress dialog keeps before dropping the oldest ones.
+TERMINAL_MAX_LINES = 5000
+
+
+def show_toast(self, message):
+    toast = Adw.Toast(title=message)
+    self.toast_overlay.add_toast(toast)
+
+
+# Calls callback once, after the next frame of the (realized) widget has been painted.
+def after_next_frame(widget, callback):
+    frame_clock = widget.get_frame_clock()
+    if frame_clock is None:
+        callback()
+        return
+
+    handler_id = None
+
+    def on_after_paint(clock):
+        clock.disconnect(handler_id)
+        callback()
+
+    handler_id = frame_clock.connect('after-paint', on_after_paint)
+
+
+def show_results(self, title, results):
+    dialog = Adw.MessageDialog(
+        transient_for=self.win,
+        heading=title,
+        body=results,
+    )
+
+    dialog.add_response("ok", "OK")
+    dialog.present()
+
 
 def setup_window(app):
     win = Adw.ApplicationWindow(application=app)
@@ -28,15 +71,22 @@ def setup_header_bar(app):
     app.toolbar_view.add_top_bar(adw_header_bar)
 
     refresh_button = Gtk.Button(icon_name='view-refresh-symbolic')
-    refresh_button.connect('clicked', lambda _: create_task(app.refresh_branches()))
+    refresh_button.connect('clicked', lambda _: app.refresh())
     header_bar.append(refresh_button)
 
     search_entry = Gtk.SearchEntry(placeholder_text="Just type...")
+    search_entry.set_search_delay(SEARCH_DELAY_MS)
     search_entry.connect('search-changed', app.on_search_changed)
     search_entry.set_hexpand(True)
     search_entry.set_halign(Gtk.Align.FILL)
     header_bar.append(search_entry)
 
+    # Only there with --debug or BRANCHY_TRACE, since there's nothing to show otherwise.
+    if metrics.enabled:
+        debug_button = Gtk.Button(icon_name='utilities-system-monitor-symbolic', tooltip_text='Debug')
+        debug_button.connect('clicked', lambda _: show_debug_panel(app))
+        header_bar.append(debug_button)
+
     apply_button = Gtk.Button(label='Apply')
     apply_button.add_css_class('suggested-action')
     apply_button.connect('clicked', app.on_apply_clicked)
@@ -46,6 +96,48 @@ def setup_header_bar(app):
     return header_bar, search_entry, apply_button
 
 
+def show_debug_panel(app):
+    window = Adw.Window(transient_for=app.win, title='Debug', default_width=560, default_height=480)
+    toolbar_view = Adw.ToolbarView()
+    header_bar = Adw.HeaderBar()
+    toolbar_view.add_top_bar(header_bar)
+
+    label = Gtk.Label(xalign=0, yalign=0, selectable=True)
+    label.add_css_class('monospace')
+    label.set_margin_top(12)
+    label.set_margin_bottom(12)
+    label.set_margin_start(12)
+    label.set_margin_end(12)
+
+    scrolled = Gtk.ScrolledWindow(vexpand=True)
+    scrolled.set_child(label)
+    toolbar_view.set_content(scrolled)
+    window.set_content(toolbar_view)
+
+    def update_summary(*_):
+        label.set_text(f"{metrics.get_summary()}\n\nrefreshes: {app.refresh.stats}\nlast update: {app.reconcile_stats}")
+
+    def save_trace(*_):
+        trace_path = path.join(CACHE_DIR, 'trace.json')
+        try:
+            makedirs(CACHE_DIR, exist_ok=True)
+        except OSError as e:
+            print(f"Error writing trace: {e}")
+        metrics.write_trace(trace_path)
+        app.show_toast(f"Trace saved to {trace_path}")
+
+    refresh_button = Gtk.Button(icon_name='view-refresh-symbolic')
+    refresh_button.connect('clicked', update_summary)
+    header_bar.pack_start(refresh_button)
+
+    save_button = Gtk.Button(label='Save Trace')
+    save_button.connect('clicked', save_trace)
+    header_bar.pack_end(save_button)
+
+    update_summary()
+    window.present()
+
+
 def setup_content(app):
     scrolled = Gtk.ScrolledWindow()
     scrolled.set_vexpand(True)
@@ -66,91 +158,263 @@ def setup_content(app):
     return content_box, scrolled, spinner
 
 
-def update_ui(app):
-    while True:
-        child = app.content_box.get_first_child()
-        if child is None:
-            break
-        app.content_box.remove(child)
+class BranchRow:
+    def __init__(self, row: Adw.ActionRow, radio: Gtk.CheckButton, branch):
+        self.row = row
+        self.radio = radio
+        self.branch = branch
+        self.subtitle = None
+        self.warning_button = None
+        self.warning = None
+
 
+class RepoCard:
+    def __init__(self, group: Adw.PreferencesGroup):
+        self.group = group
+        self.rows: Dict[str, BranchRow] = OrderedDict()
+
+
+class RowState(NamedTuple):
+    active: bool
+    sensitive: bool
+    subtitle: str
+    warning: Optional[Tuple[str, str]]
+
+
+@dataclass
+class ReconcileStats:
+    created: int = 0
+    reused: int = 0
+    removed: int = 0
+
+    def __str__(self):
+        return f"{self.created} created, {self.reused} reused, {self.removed} removed"
+
+
+def update_ui(app) -> ReconcileStats:
+    stats = ReconcileStats()
+
+    for repo in list(app.repo_cards):
+        if repo not in app.repositories:
+            card = app.repo_cards.pop(repo)
+            app.content_box.remove(card.group)
+            for name in card.rows:
+                app.radios.pop((repo, name), None)
+            stats.removed += 1 + len(card.rows)
+
+    previous_group = None
     for repo, repository in app.repositories.items():
-        repo_card = Adw.PreferencesGroup(title=repo)
-        app.content_box.append(repo_card)
+        card = app.repo_cards.get(repo)
+        if card is None:
+            card = RepoCard(Adw.PreferencesGroup(title=repo))
+            app.repo_cards[repo] = card
+            app.content_box.append(card.group)
+            stats.created += 1
+        else:
+            stats.reused += 1
 
-        radio_group = None
-        for branch in repository.branches:
-            row = Adw.ActionRow(title=branch.name)
-            time_ago = get_time_ago(branch.timestamp)
-            row.set_subtitle(f"{time_ago}")
+        app.content_box.reorder_child_after(card.group, previous_group)
+        previous_group = card.group
 
-            radio = Gtk.CheckButton()
-            row.add_suffix(radio)
-            radio.set_group(radio_group)
+        reconcile_rows(app, repo, repository, card, stats)
 
-            branch.radio = radio
+    reset_changed_branches(app)
 
-            if radio_group is None:
-                radio_group = radio
+    return stats
 
-            # Irritatingly, we can't use the radio's button toggled signal because it wouldn't allow the user to disable
-            # a branch that is already enabled, nor does it play nice with our ternary state for the radio buttons. So we
-            # just use a gesture to handle the toggling.
-            click_controller = Gtk.GestureClick()
-            click_controller.connect('released', lambda gesture, button, x, y, radio, repo, branch: app.on_branch_toggled(radio, repo, branch), radio, repo, branch)
-            row.add_controller(click_controller)
 
-            # We also have to disable clicking on the radio button, since we handle the toggling ourselves.
-            # We do this by removing the default click controller. :/
-            click_controller = radio.observe_controllers()[0]
-            if click_controller:
-                radio.remove_controller(click_controller)
+def reset_changed_branches(app):
+    # Imported here so that none of the sys machinery is loaded before the first frame.
+    from .sys import get_removed_branches
+    app.changed_branches = get_removed_branches(app)
+    app.apply_button.set_sensitive(not not app.changed_branches)
 
-            radio.set_active(app.enabled_branches.get(repo) == branch.name)
 
-            if repo in app.system_branches:
-                system_branch, system_file = app.system_branches[repo]
-                if branch.name == system_branch:
-                    radio.set_active(app.enabled_branches.get(repo, branch.name) == branch.name)
-                    radio.set_sensitive(False)
-                    row.set_subtitle(f"{row.get_subtitle()} · from {system_file}")
+# Same as reset_changed_branches, for just these repositories. Changes to the others are kept.
+def reset_changed_repos(app, repos):
+    from .sys import get_removed_branches
+    removed_branches = get_removed_branches(app)
+    for repo in repos:
+        app.changed_branches.pop(repo, None)
+        if repo in removed_branches:
+            app.changed_branches[repo] = removed_branches[repo]
+    app.apply_button.set_sensitive(not not app.changed_branches)
 
-            if app.enabled_branches.get(repo) == branch.name and branch.version and app.installed_versions.get(repo) and branch.version != app.installed_versions[repo]:
-                radio.set_inconsistent(True)
-                radio.set_css_classes(['update-needed-untouched'])
-                # row.set_subtitle(f"{row.get_subtitle()} · ⚠️ version mismatch ⚠️")
 
-                warning_button = Gtk.MenuButton.new()
-                warning_button.set_icon_name('dialog-warning-symbolic')
-                warning_button.set_has_frame(False)
+def update_repo_rows(app, repos):
+    for repo in repos:
+        card = app.repo_cards.get(repo)
+        if card is not None:
+            for branch_row in card.rows.values():
+                sync_branch_row(app, repo, branch_row.branch, branch_row)
 
-                popover = Gtk.Popover()
-                info_container = Adw.Clamp()
-                info_container.set_maximum_size(app.win.get_width() / 2 - 24)
 
-                info_container.set_margin_top(6)
-                info_container.set_margin_bottom(6)
-                info_container.set_margin_start(6)
-                info_container.set_margin_end(6)
+def reconcile_rows(app, repo, repository, card: RepoCard, stats: ReconcileStats):
+    branch_names = [branch.name for branch in repository.branches]
 
-                info_label = Gtk.Label(label=f"Installed: {app.installed_versions[repo]}\n\nAvailable: {branch.version}")
-                info_label.set_wrap(True)
+    for name in [name for name in card.rows if name not in repository.branches_by_name]:
+        card.group.remove(card.rows.pop(name).row)
+        app.radios.pop((repo, name), None)
+        stats.removed += 1
 
-                info_container.set_child(info_label)
-                popover.set_child(info_container)
-                warning_button.set_popover(popover)
+    radio_group = next((branch_row.radio for branch_row in card.rows.values()), None)
+    for branch in repository.branches:
+        branch_row = card.rows.get(branch.name)
+        if branch_row is None:
+            branch_row = create_branch_row(app, repo, branch, radio_group)
+            card.rows[branch.name] = branch_row
+            card.group.add(branch_row.row)
+            stats.created += 1
+        else:
+            branch_row.branch = branch
+            stats.reused += 1
 
-                row.add_prefix(warning_button)
+        if radio_group is None:
+            radio_group = branch_row.radio
 
-            repo_card.add(row)
+        app.radios[(repo, branch.name)] = branch_row.radio
+        sync_branch_row(app, repo, branch, branch_row)
 
-    app.changed_branches = {}
+    # Preferences groups can't reorder their rows, so if the order changed we have to take them out and put them back in.
+    if list(card.rows) != branch_names:
+        for branch_row in card.rows.values():
+            card.group.remove(branch_row.row)
+        card.rows = OrderedDict((name, card.rows[name]) for name in branch_names)
+        for branch_row in card.rows.values():
+            card.group.add(branch_row.row)
 
-    # If branches got removed from the server, enabled_branches won't match initial_branches. Detect that and add them to changed_branches.
-    for repo, branch in app.initial_branches.items():
-        if repo not in app.enabled_branches or branch not in app.enabled_branches[repo]:
-            app.changed_branches[repo] = (branch, None)
 
-    app.apply_button.set_sensitive(not not app.changed_branches)
+def create_branch_row(app, repo, branch, radio_group) -> BranchRow:
+    row = Adw.ActionRow(title=branch.name)
+
+    radio = Gtk.CheckButton()
+    row.add_suffix(radio)
+    radio.set_group(radio_group)
+
+    branch_row = BranchRow(row, radio, branch)
+
+    # Irritatingly, we can't use the radio's button toggled signal because it wouldn't allow the user to disable
+    # a branch that is already enabled, nor does it play nice with our ternary state for the radio buttons. So we
+    # just use a gesture to handle the toggling.
+    click_controller = Gtk.GestureClick()
+    click_controller.connect('released', lambda *_: app.on_branch_toggled(branch_row.radio, repo, branch_row.branch))
+    row.add_controller(click_controller)
+
+    # We also have to disable clicking on the radio button, since we handle the toggling ourselves.
+    # We do this by removing the default click controller. :/
+    click_controller = radio.observe_controllers()[0]
+    if click_controller:
+        radio.remove_controller(click_controller)
+
+    return branch_row
+
+
+def get_row_state(app, repo, branch) -> RowState:
+    active = app.enabled_branches.get(repo) == branch.name
+    sensitive = True
+    subtitle = get_time_ago(branch.timestamp)
+
+    if repo in app.system_branches:
+        system_branch, system_file = app.system_branches[repo]
+        if branch.name == system_branch:
+            active = app.enabled_branches.get(repo, branch.name) == branch.name
+            sensitive = False
+            subtitle = f"{subtitle} · from {system_file}"
+
+    warning = None
+    if app.enabled_branches.get(repo) == branch.name and branch.version and app.installed_versions.get(repo) and branch.version != app.installed_versions[repo]:
+        warning = (app.installed_versions[repo], branch.version)
+
+    return RowState(active, sensitive, subtitle, warning)
+
+
+def sync_branch_row(app, repo, branch, branch_row: BranchRow):
+    row, radio = branch_row.row, branch_row.radio
+    state = get_row_state(app, repo, branch)
+
+    # Rows are reused across refreshes, so whatever the user toggled before has to be reset here.
+    radio.set_css_classes(['update-needed-untouched'] if state.warning else [])
+    radio.set_inconsistent(state.warning is not None)
+    radio.set_sensitive(state.sensitive)
+    radio.set_active(state.active)
+
+    if branch_row.subtitle != state.subtitle:
+        row.set_subtitle(state.subtitle)
+        branch_row.subtitle = state.subtitle
+
+    if state.warning == branch_row.warning:
+        return
+
+    if branch_row.warning_button is not None:
+        row.remove(branch_row.warning_button)
+        branch_row.warning_button = None
+
+    branch_row.warning = state.warning
+    if state.warning is not None:
+        branch_row.warning_button = create_warning_button(app, *state.warning)
+        row.add_prefix(branch_row.warning_button)
+
+
+def create_warning_button(app, installed_version, available_version) -> Gtk.MenuButton:
+    warning_button = Gtk.MenuButton.new()
+    warning_button.set_icon_name('dialog-warning-symbolic')
+    warning_button.set_has_frame(False)
+
+    popover = Gtk.Popover()
+    info_container = Adw.Clamp()
+    info_container.set_maximum_size(app.win.get_width() / 2 - 24)
+
+    info_container.set_margin_top(6)
+    info_container.set_margin_bottom(6)
+    info_container.set_margin_start(6)
+    info_container.set_margin_end(6)
+
+    info_label = Gtk.Label(label=f"Installed: {installed_version}\n\nAvailable: {available_version}")
+    info_label.set_wrap(True)
+
+    info_container.set_child(info_label)
+    popover.set_child(info_container)
+    warning_button.set_popover(popover)
+
+    return warning_button
+
+
+def apply_search(app, visible, previous):
+    # Only rows whose visibility can have changed are touched. If we don't know what was visible before, that's all of them.
+    if visible is None or previous is None:
+        repos, keys = app.repo_cards, ((repo, name) for repo, card in app.repo_cards.items() for name in card.rows)
+    else:
+        changed = visible ^ previous
+        repos = [key for key in changed if isinstance(key, str)]
+        keys = [key for key in changed if isinstance(key, tuple)]
+
+    for repo in repos:
+        card = app.repo_cards.get(repo)
+        if card is not None:
+            card.group.set_visible(visible is None or repo in visible)
+
+    for repo, name in keys:
+        card = app.repo_cards.get(repo)
+        if card is not None and name in card.rows:
+            card.rows[name].row.set_visible(visible is None or (repo, name) in visible)
+
+
+def restore_scroll_position(app):
+    adjustment = app.scrolled.get_vadjustment()
+    value = app.scroll_position
+
+    # Only the latest position is wanted, so one that's still waiting to be restored is dropped.
+    if app.scroll_handler is not None:
+        adjustment.disconnect(app.scroll_handler)
+
+    # The content has to be laid out again before the adjustment knows how far it can scroll, which is what the next
+    # change is. Whatever it says, the handler only runs once, so a later change can't jump back to this position.
+    def on_changed(adjustment):
+        adjustment.disconnect(app.scroll_handler)
+        app.scroll_handler = None
+        adjustment.set_value(value)
+
+    app.scroll_handler = adjustment.connect('changed', on_changed)
 
 
 def setup_progress_dialog(app, title) -> tuple[Adw.Dialog, Gtk.Label, Gtk.TextView, Gtk.Button]:
@@ -190,3 +454,45 @@ def setup_progress_dialog(app, title) -> tuple[Adw.Dialog, Gtk.Label, Gtk.TextVi
     content_box.append(close_button)
 
     return dialog, title_label, terminal, close_button
+
+
+class TerminalWriter:
+    def __init__(self, terminal: Gtk.TextView, max_lines: int = TERMINAL_MAX_LINES):
+        self.terminal = terminal
+        self.buffer = terminal.get_buffer()
+        self.end_mark = self.buffer.create_mark(None, self.buffer.get_end_iter(), False)
+        self.max_lines = max_lines
+        self.pending = []
+        self.tick_id = None
+        self.follow = True
+
+        terminal.get_vadjustment().connect('value-changed', self.on_scrolled)
+
+    # Output can arrive far faster than we can draw it, so it's queued up and written out at most once per frame.
+    def write(self, data):
+        self.pending.append(data.decode('utf-8', errors='replace') if isinstance(data, bytes) else data)
+        if self.tick_id is None:
+            self.tick_id = self.terminal.add_tick_callback(self.on_tick)
+
+    def on_tick(self, widget, frame_clock) -> bool:
+        self.tick_id = None
+        self.flush()
+        return GLib.SOURCE_REMOVE
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        self.buffer.insert(self.buffer.get_end_iter(), ''.join(self.pending))
+        self.pending = []
+
+        excess_lines = self.buffer.get_line_count() - self.max_lines
+        if excess_lines > 0:
+            self.buffer.delete(self.buffer.get_start_iter(), self.buffer.get_iter_at_line(excess_lines)[1])
+
+        if self.follow:
+            self.terminal.scroll_to_mark(self.end_mark, 0.0, False, 0.0, 1.0)
+
+    # Autoscrolling stops while the user has scrolled up, and picks up again once they're back at the bottom.
+    def on_scrolled(self, adjustment):
+        self.follow = adjustment.get_value() >= adjustment.get_upper() - adjustment.get_page_size() - 1
@@ -1,13 +1,48 @@
-from re import match
+from re import compile, escape
 from datetime import datetime, timedelta
-from gi.repository import Adw
+from os import environ
 
-SOURCES_DIR = '/etc/apt/sources.list.d'
-BRANCH_LIST_URL = 'http://repo.furios.io/get-branches'
+# Both can be pointed elsewhere from the environment, e.g. at a scratch directory and a local server for testing.
+SOURCES_DIR = environ.get('BRANCHY_SOURCES_DIR', '/etc/apt/sources.list.d')
+BRANCH_LIST_URL = environ.get('BRANCHY_BRANCH_LIST_URL', 'http://repo.furios.io/get-branches')
 ENABLED_BRANCHES_NAME = 'experiments.list'
+ENABLED_BRANCHES_DEB822_NAME = 'experiments.sources'
 CODENAME = 'trixie'
 DEB_URL_TEMPLATE = 'http://furilabs-{repo}.repo.furios.io/{codename}-{branch}/'
 
+REPO_NAME_PATTERN = r'[a-z0-9.\-+]+'
+BRANCH_NAME_PATTERN = r'[a-z0-9.\-]+'
+PACKAGE_NAME_PATTERN = r'[a-z0-9.\-]+'
+VERSION_PATTERN = r'[a-z0-9.\-+~:]+'
+
+REPO_NAME_RE = compile(REPO_NAME_PATTERN)
+BRANCH_NAME_RE = compile(BRANCH_NAME_PATTERN)
+PACKAGE_NAME_RE = compile(PACKAGE_NAME_PATTERN)
+VERSION_RE = compile(VERSION_PATTERN)
+# A whole URI from a sources file, for matching with fullmatch.
+DEB_URL_RE = compile(escape(DEB_URL_TEMPLATE.format(repo='REPO', codename=CODENAME, branch='BRANCH'))
+                     .replace('REPO', f'({REPO_NAME_PATTERN})').replace('BRANCH', f'({BRANCH_NAME_PATTERN})'))
+
+# The same patterns, for a whole column of a batch of records joined by newlines.
+REPO_NAME_COLUMN_RE = compile(rf'{REPO_NAME_PATTERN}(?:\n{REPO_NAME_PATTERN})*')
+BRANCH_NAME_COLUMN_RE = compile(rf'{BRANCH_NAME_PATTERN}(?:\n{BRANCH_NAME_PATTERN})*')
+PACKAGE_LIST_COLUMN_RE = compile(rf'{PACKAGE_NAME_PATTERN}(?:[ \n]{PACKAGE_NAME_PATTERN})*')
+VERSION_COLUMN_RE = compile(rf'{VERSION_PATTERN}(?:\n{VERSION_PATTERN})*')
+
+# How many problems an InvalidBranchData message lists before it gives up.
+MAX_LISTED_ERRORS = 10
+
+
+class InvalidBranchData(ValueError):
+    # errors holds (record number, problem) pairs.
+    def __init__(self, errors: list[tuple[int, str]]):
+        self.errors = errors
+
+        listed = '\n'.join(f"Record {number}: {problem}" for number, problem in errors[:MAX_LISTED_ERRORS])
+        if len(errors) > MAX_LISTED_ERRORS:
+            listed += f"\n...and {len(errors) - MAX_LISTED_ERRORS} more"
+        super().__init__(f"{len(errors)} invalid branch record{'' if len(errors) == 1 else 's'}:\n{listed}")
+
 
 def validate_branch_data(repo: str, branch: str, packages: list[str], version: str):
     if not repo:
@@ -19,30 +54,37 @@ def validate_branch_data(repo: str, branch: str, packages: list[str], version: s
     if not version:
         raise ValueError("Version cannot be empty")
 
-    if not match(r'^[a-z0-9.\-+]+$', repo):
+    if not REPO_NAME_RE.fullmatch(repo):
         raise ValueError(f"Invalid repo name: {repo}")
-    if not match(r'^[a-z0-9.\-+~:]+$', version):
+    if not VERSION_RE.fullmatch(version):
         raise ValueError(f"Invalid version: {version}")
-    if not match(r'^[a-z0-9.\-]+$', branch):
+    if not BRANCH_NAME_RE.fullmatch(branch):
         raise ValueError(f"Invalid branch name: {branch}")
-    if not all(match(r'^[a-z0-9.\-]+$', package) for package in packages):
+    if not all(PACKAGE_NAME_RE.fullmatch(package) for package in packages):
         raise ValueError(f"Invalid package names: {' '.join(packages)}")
 
 
-def show_toast(self, message):
-    toast = Adw.Toast(title=message)
-    self.toast_overlay.add_toast(toast)
+# Validates a batch of (repo, branch, packages, version) records, with packages still a space separated string. Each
+# column is checked for the whole batch with a single match, and only if that fails do we go record by record to find
+# out which ones are at fault, so that every one of them ends up in the InvalidBranchData that's raised.
+def validate_branch_records(records: list[tuple[str, str, str, str]], first_record_number: int = 1):
+    if not records:
+        return
 
+    repos, branches, packages, versions = zip(*records)
+    if (REPO_NAME_COLUMN_RE.fullmatch('\n'.join(repos)) and BRANCH_NAME_COLUMN_RE.fullmatch('\n'.join(branches))
+            and PACKAGE_LIST_COLUMN_RE.fullmatch('\n'.join(packages)) and VERSION_COLUMN_RE.fullmatch('\n'.join(versions))):
+        return
 
-def show_results(self, title, results):
-    dialog = Adw.MessageDialog(
-        transient_for=self.win,
-        heading=title,
-        body=results,
-    )
+    errors = []
+    for number, (repo, branch, package_list, version) in enumerate(records, first_record_number):
+        try:
+            validate_branch_data(repo, branch, package_list.split(' ') if package_list else [], version)
+        except ValueError as e:
+            errors.append((number, str(e)))
 
-    dialog.add_response("ok", "OK")
-    dialog.present()
+    if errors:
+        raise InvalidBranchData(errors)
 
 
 def get_time_ago(timestamp: int) -> str:
@@ -68,3 +110,12 @@ def get_time_ago(timestamp: int) -> str:
 
     s = "" if n == 1 else "s"
     return f"{n} {word}{s} ago"
+
+
+# Sizes in the same units apt uses when it asks for confirmation.
+def format_size(size: int) -> str:
+    for unit in ('B', 'kB', 'MB'):
+        if abs(size) < 1000:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1000
+    return f"{size:.1f} GB"
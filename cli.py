@@ -0,0 +1,8 @@
+#!/usr/bin/env python3
+
+from branchy.cli import main
+from sys import argv, exit
+
+
+if __name__ == '__main__':
+    exit(main(argv[1:]))
@@ -1,31 +1,26 @@
 #!/usr/bin/env python3
 
-import gi
+# This doesn't pull in anything else, so the imports below can be timed too.
+from branchy.startup import startup_profile
 
-from gi.repository import GLib, Gio
+with startup_profile.phase('import gi'):
+    import gi
 
-gi.require_version('Gtk', '4.0')
-gi.require_version('Adw', '1')
+    gi.require_version('Gtk', '4.0')
+    gi.require_version('Adw', '1')
 
-from branchy import BranchyApp
-from asyncio import run, sleep
-from sys import exit
+    from gi.repository import Gio
 
+with startup_profile.phase('import branchy'):
+    from branchy import BranchyApp
+    from branchy.loop import run_app
 
-async def pump_gtk_events():
-    main_context = GLib.MainContext.default()
+from sys import argv, exit
+
+
+if __name__ == '__main__':
     app = BranchyApp()
     app.connect('shutdown', lambda _: exit(0))
 
     Gio.Application.set_default(app)
-    app.register()
-
-    app.activate()
-
-    while True:
-        while main_context.pending():
-            main_context.iteration(False)
-        await sleep(1 / 160)
-
-if __name__ == '__main__':
-    run(pump_gtk_events())
+    exit(run_app(app, argv))